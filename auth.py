@@ -1,8 +1,16 @@
 import os
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
 from jose import JWTError, jwt
 from fastapi import HTTPException, Request
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telemetry import stage
 
 
 # Load environment variables
@@ -15,43 +23,199 @@ AUTH0_CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
 AUTH0_CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
 AUTH0_AUDIENCE = os.getenv("AUTH0_AUDIENCE")
 
+AUTH0_TIMEOUT = float(os.getenv("AUTH0_TIMEOUT", "10"))
+MANAGEMENT_TOKEN_REFRESH_MARGIN = int(os.getenv("AUTH0_MANAGEMENT_TOKEN_REFRESH_MARGIN", "300"))
+
+class _Auth0Retry(Retry):
+    # A 503 can come from Auth0's edge after the request was processed, so a POST (user
+    # create, token request) is only retried on 429, which means it was rejected unseen
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Shared HTTP session for all Auth0 traffic: keep-alive pooling and bounded retries.
+# Connection failures are retried for every method, 503 only for GETs and 429 for
+# GETs and POSTs, so a non-idempotent POST that reached Auth0 is never sent twice.
+def _create_auth0_adapter():
+    retry = _Auth0Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=2,
+        backoff_factor=0.3,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    )
+    return HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=int(os.getenv("AUTH0_POOL_SIZE", "20")),
+        max_retries=retry,
+    )
+
+def _create_auth0_session():
+    session = requests.Session()
+    adapter = _create_auth0_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+auth0_session = _create_auth0_session()
+
+# Pooled connections must not be shared with forked workers (see serve.py); the
+# session object is kept since other modules import it by name
+def _reset_auth0_session_after_fork():
+    adapter = _create_auth0_adapter()
+    auth0_session.mount("https://", adapter)
+    auth0_session.mount("http://", adapter)
+
+os.register_at_fork(after_in_child=_reset_auth0_session_after_fork)
+
+# Cached Management API token, refreshed shortly before it expires
+_management_token = {"access_token": None, "expires_at": 0.0}
+_management_token_lock = threading.Lock()
+
 def get_auth0_token():
-    url = f'https://{AUTH0_DOMAIN}/oauth/token'
-    headers = { 'content-type': 'application/json' }
-    payload = {
-        'client_id': AUTH0_CLIENT_ID,
-        'client_secret': AUTH0_CLIENT_SECRET,
-        'audience': f'https://{AUTH0_DOMAIN}/api/v2/',
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    return response.json()['access_token']
+    if _management_token["access_token"] and time.monotonic() < _management_token["expires_at"]:
+        return _management_token["access_token"]
+
+    with _management_token_lock:
+        # Another thread may have refreshed the token while we were waiting
+        if _management_token["access_token"] and time.monotonic() < _management_token["expires_at"]:
+            return _management_token["access_token"]
+
+        url = f'https://{AUTH0_DOMAIN}/oauth/token'
+        headers = { 'content-type': 'application/json' }
+        payload = {
+            'client_id': AUTH0_CLIENT_ID,
+            'client_secret': AUTH0_CLIENT_SECRET,
+            'audience': f'https://{AUTH0_DOMAIN}/api/v2/',
+            'grant_type': 'client_credentials'
+        }
+        response = auth0_session.post(url, json=payload, headers=headers, timeout=AUTH0_TIMEOUT)
+        token_data = response.json()
+        expires_in = int(token_data.get('expires_in', 86400))
+        _management_token["access_token"] = token_data['access_token']
+        _management_token["expires_at"] = time.monotonic() + max(expires_in - MANAGEMENT_TOKEN_REFRESH_MARGIN, 0)
+        return _management_token["access_token"]
+
+# Function to drop the cached Management API token, e.g. after Auth0 rejected it
+def invalidate_auth0_token():
+    with _management_token_lock:
+        _management_token["access_token"] = None
+        _management_token["expires_at"] = 0.0
+
+# Process-wide cache of Auth0 signing keys, indexed by 'kid'
+class JWKSCache:
+    """
+    Caches the JWKS document so token verification doesn't hit Auth0 on every request.
+
+    Keys are indexed by 'kid' and kept for the max-age advertised by Auth0's
+    Cache-Control header. An unknown 'kid' triggers a single-flight refresh, rate
+    limited by a cooldown so a flood of bad tokens can't cause a refetch storm.
+    If Auth0 is unreachable, the last known keys keep being served for up to
+    `max_stale` seconds.
+    """
+
+    def __init__(self, jwks_url, default_ttl=600, min_refresh_interval=30, max_stale=86400, timeout=AUTH0_TIMEOUT):
+        self.jwks_url = jwks_url
+        self.default_ttl = default_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.max_stale = max_stale
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._lock = threading.Lock()
+
+    def _max_age(self, response):
+        # Honor 'Cache-Control: max-age=N', falling back to the default TTL
+        cache_control = response.headers.get("Cache-Control", "")
+        for directive in cache_control.split(","):
+            name, _, value = directive.strip().partition("=")
+            if name.lower() == "max-age" and value.isdigit():
+                return int(value)
+        return self.default_ttl
+
+    def _fetch(self):
+        response = auth0_session.get(self.jwks_url, timeout=self.timeout)
+        response.raise_for_status()
+        keys = {key["kid"]: key for key in response.json()["keys"] if "kid" in key}
+        return keys, self._max_age(response)
+
+    def _refresh(self, force=False):
+        observed = self._fetched_at
+        with self._lock:
+            # Another thread refreshed while we were waiting for the lock
+            if self._fetched_at != observed:
+                return
+
+            now = time.monotonic()
+            if not force and now < self._expires_at:
+                return
+            if now - self._last_attempt < self.min_refresh_interval:
+                return
+            self._last_attempt = now
+
+            try:
+                keys, max_age = self._fetch()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if self._keys and now - self._fetched_at < self.max_stale:
+                    logging.warning(f"JWKS refresh failed, serving stale keys: {e}")
+                    return
+                logging.error(f"JWKS refresh failed: {e}")
+                raise HTTPException(status_code=503, detail="Unable to fetch signing keys")
+
+            self._keys = keys
+            self._fetched_at = now
+            self._expires_at = now + max_age
+
+    def get_key(self, kid: str):
+        if time.monotonic() >= self._expires_at:
+            self._refresh()
+        key = self._keys.get(kid)
+        if key is None:
+            # Possibly a key rotation, refetch (subject to the cooldown)
+            self._refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def keys(self):
+        if time.monotonic() >= self._expires_at:
+            self._refresh()
+        return list(self._keys.values())
+
+
+jwks_cache = JWKSCache(
+    f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+    default_ttl=int(os.getenv("JWKS_CACHE_TTL", "600")),
+    min_refresh_interval=int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30")),
+    max_stale=int(os.getenv("JWKS_MAX_STALE", "86400")),
+)
 
 # Function to get the JWKS from Auth0
 def get_jwks():
-    jwks_url = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
-    jwks = requests.get(jwks_url).json()
-    return jwks['keys']
+    return jwks_cache.keys()
 
 # Function to find the RSA key from the JWKS based on the 'kid' in the token header
 def get_rsa_key(token: str):
     try:
-        jwks = get_jwks()
         unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
-                break
-        if not rsa_key:
+        key = jwks_cache.get_key(unverified_header.get("kid"))
+        if not key:
             raise HTTPException(status_code=401, detail="Unable to find appropriate key")
-        return rsa_key
+        return {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key["use"],
+            "n": key["n"],
+            "e": key["e"]
+        }
     except JWTError as e:
         raise HTTPException(status_code=401, detail=f"JWT decoding error: {str(e)}")
 
@@ -70,6 +234,79 @@ def verify_jwt(token: str):
     except JWTError as e:
         raise HTTPException(status_code=401, detail=f"Token verification failed: {str(e)}")
 
+# Bounded LRU of verified token claims, so repeated bearer tokens skip RSA verification
+class VerifiedTokenCache:
+    """
+    Maps a SHA-256 of the raw token to its verified claims until the token's 'exp'.
+
+    The cache is bounded both by entry count and by an approximate byte size of
+    the stored claims; the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            claims, expires_at, size = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: dict):
+        expires_at = claims.get("exp")
+        if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+            return
+        key = self._key(token)
+        size = len(key) + len(repr(claims))
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (claims, expires_at, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+token_cache = VerifiedTokenCache(
+    max_entries=int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000")),
+    max_bytes=int(os.getenv("AUTH_TOKEN_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
 # Function to extract and verify the user from the request
 def get_current_user(request: Request):
     auth_header = request.headers.get("Authorization")
@@ -77,4 +314,9 @@ def get_current_user(request: Request):
         raise HTTPException(status_code=403, detail="Authorization header missing")
     
     token = auth_header.split(" ")[1]
-    return verify_jwt(token)  # Decode and verify the token
+    with stage("auth"):
+        claims = token_cache.get(token)
+        if claims is None:
+            claims = verify_jwt(token)  # Decode and verify the token
+            token_cache.put(token, claims)
+    return claims
@@ -0,0 +1,450 @@
+"""
+Local stand-ins for every external dependency of the chat path, so it can be
+benchmarked offline: a fake Claude model, deterministic embeddings, an in-memory
+Qdrant seeded with sample chunks, an in-memory async Mongo, and locally signed JWTs
+verified against a locally served JWKS.
+"""
+import os
+import asyncio
+import base64
+import copy
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+BENCH_DOMAIN = "bench.midnight-diner.local"
+BENCH_AUDIENCE = "https://bench.midnight-diner.local/api"
+BENCH_COLLECTION = "bench_chunks"
+
+
+def configure_environment():
+    # Must run before importing any of the app modules, which read these at import time
+    os.environ.update({
+        "AUTH0_DOMAIN": BENCH_DOMAIN,
+        "AUTH0_AUDIENCE": BENCH_AUDIENCE,
+        "AUTH0_ALGORITHM": "RS256",
+        "QDRANT_COLLECTION_NAME": BENCH_COLLECTION,
+        "RETRIEVER_BACKEND": "qdrant",
+        "DB_NAME": "bench",
+        "MONGO_URI": "mongodb://bench.invalid:27017",
+    })
+
+
+SAMPLE_TEXTS = [
+    "Stress is the body's response to demands, and short breaks can help reset the nervous system.",
+    "Slow breathing, such as inhaling for four seconds and exhaling for six, activates the relaxation response.",
+    "Grounding techniques like naming five things you can see help during moments of anxiety.",
+    "Keeping a regular sleep schedule and limiting screens before bed improves sleep quality.",
+    "Loneliness is common, and reaching out to one trusted person is a meaningful first step.",
+    "Journaling about worries before bed can reduce rumination and help the mind settle.",
+    "Physical activity, even a short walk, lowers stress hormones and improves mood.",
+    "Setting boundaries at work protects time for rest and relationships.",
+    "Self-compassion means treating yourself with the kindness you would offer a friend.",
+    "If thoughts of self-harm appear, contacting a crisis line or a professional is important.",
+    "Progressive muscle relaxation tenses and releases muscle groups to reduce tension.",
+    "Cognitive reframing looks for alternative, balanced explanations for stressful events.",
+    "Small routines such as a morning stretch give structure to difficult days.",
+    "Talking to a therapist can help identify patterns that keep anxiety going.",
+    "Gratitude practices shift attention toward what is going well without denying difficulties.",
+    "Mindfulness means noticing thoughts and feelings without judging them.",
+]
+
+
+def sample_chunks(count):
+    """Returns `count` distinct sample chunks built from SAMPLE_TEXTS."""
+    texts = itertools.cycle(SAMPLE_TEXTS)
+    return [f"{next(texts)} {next(texts)} (note {i})" for i in range(count)]
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings: each token is hashed to a signed index.
+    Texts sharing words get similar vectors, which is enough to exercise retrieval
+    without downloading a model.
+    """
+
+    def __init__(self, dim=384, delay=0.0):
+        self.dim = dim
+        self.delay = delay
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.delay:
+            time.sleep(self.delay * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model stand-in with configurable time to first token and token rate.
+    """
+
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    response: str = (
+        "It sounds like you're carrying a lot right now. Try a few slow breaths, "
+        "and remember that reaching out, like you did today, is a real step forward."
+    )
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _tokens(self):
+        return re.findall(r"\S+\s*", self.response)
+
+    def _duration(self):
+        return self.latency + len(self._tokens()) / self.tokens_per_second
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._duration())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._duration())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for token in self._tokens():
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def sample_points(chunks, embeddings):
+    from qdrant_client.models import PointStruct
+    from retriever import CONTENT_PAYLOAD_KEY
+
+    vectors = embeddings.embed_documents(chunks)
+    return [
+        PointStruct(
+            id=i,
+            vector=vector,
+            payload={CONTENT_PAYLOAD_KEY: chunk, "source": "sample.pdf", "page": i // 4, "chunk": i % 4},
+        )
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors))
+    ]
+
+
+def seeded_qdrant_clients(chunks, embeddings, collection_name=BENCH_COLLECTION):
+    """
+    Returns sync and async in-memory Qdrant clients holding the same sample points.
+    The two in-memory clients don't share storage, so both are seeded.
+    """
+    from qdrant_client import AsyncQdrantClient, QdrantClient
+    from qdrant_client.models import Distance, VectorParams
+
+    points = sample_points(chunks, embeddings)
+    vectors_config = VectorParams(size=len(points[0].vector), distance=Distance.COSINE)
+
+    client = QdrantClient(":memory:")
+    client.create_collection(collection_name, vectors_config=vectors_config)
+    client.upsert(collection_name, points=points)
+
+    async_client = AsyncQdrantClient(":memory:")
+
+    async def seed():
+        await async_client.create_collection(collection_name, vectors_config=vectors_config)
+        await async_client.upsert(collection_name, points=points)
+
+    return client, async_client, seed
+
+
+# --- In-memory async MongoDB ---------------------------------------------------------
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        value = doc.get(key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, arg in condition.items():
+                if op == "$gt":
+                    ok = value is not None and value > arg
+                elif op == "$gte":
+                    ok = value is not None and value >= arg
+                elif op == "$lt":
+                    ok = value is not None and value < arg
+                elif op == "$lte":
+                    ok = value is not None and value <= arg
+                elif op == "$in":
+                    ok = value in arg
+                elif op == "$exists":
+                    ok = (key in doc) == bool(arg)
+                else:
+                    raise NotImplementedError(f"Fake Mongo doesn't support {op}")
+                if not ok:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _apply_update(doc, update, inserting):
+    for op, fields in update.items():
+        if op == "$set":
+            doc.update(copy.deepcopy(fields))
+        elif op == "$setOnInsert":
+            if inserting:
+                doc.update(copy.deepcopy(fields))
+        elif op == "$inc":
+            for key, amount in fields.items():
+                doc[key] = doc.get(key, 0) + amount
+        elif op == "$unset":
+            for key in fields:
+                doc.pop(key, None)
+        else:
+            raise NotImplementedError(f"Fake Mongo doesn't support {op}")
+
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    included = {key for key, keep in projection.items() if keep and key != "_id"}
+    if included:
+        result = {key: doc[key] for key in included if key in doc}
+        if projection.get("_id", 1):
+            result["_id"] = doc["_id"]
+    else:
+        result = {key: value for key, value in doc.items() if projection.get(key, 1)}
+    return copy.deepcopy(result)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+        self._limit = None
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    async def to_list(self, length=None):
+        docs = self._docs[:self._limit] if self._limit else self._docs
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in await self.to_list():
+            yield doc
+
+
+class FakeCollection:
+    """The subset of the async collection API used by user.py."""
+
+    def __init__(self, name):
+        self.name = name
+        self._docs = []
+        self._unique = []
+        self._ids = itertools.count(1)
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        fields = [keys] if isinstance(keys, str) else [key for key, _ in keys]
+        if unique:
+            self._unique.append(fields)
+        return "_".join(fields)
+
+    def _check_unique(self, doc):
+        from pymongo.errors import DuplicateKeyError
+
+        for fields in self._unique:
+            key = [doc.get(field) for field in fields]
+            if any(existing is not doc and [existing.get(field) for field in fields] == key for existing in self._docs):
+                raise DuplicateKeyError(f"Duplicate key {dict(zip(fields, key))} in {self.name}")
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", next(self._ids))
+        self._check_unique(doc)
+        self._docs.append(doc)
+        return doc
+
+    def _find(self, query):
+        return [doc for doc in self._docs if _matches(doc, query)]
+
+    async def find_one(self, query, projection=None):
+        docs = self._find(query)
+        return _project(docs[0], projection) if docs else None
+
+    def find(self, query, projection=None):
+        return FakeCursor([_project(doc, projection) for doc in self._find(query)])
+
+    async def insert_one(self, doc):
+        return _Result(inserted_id=self._insert(doc)["_id"])
+
+    async def insert_many(self, docs, ordered=True):
+        return _Result(inserted_ids=[self._insert(doc)["_id"] for doc in docs])
+
+    async def bulk_write(self, requests, ordered=True):
+        # Only InsertOne is used (by the history writer); duplicates are reported like the server does
+        from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+        write_errors, inserted = [], 0
+        for index, request in enumerate(requests):
+            try:
+                self._insert(dict(request._doc))
+                inserted += 1
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "writeConcernErrors": [], "nInserted": inserted})
+        return _Result(inserted_count=inserted)
+
+    def _upsert_doc(self, query):
+        return {key: value for key, value in query.items() if not isinstance(value, dict)}
+
+    async def update_one(self, query, update, upsert=False):
+        docs = self._find(query)
+        if docs:
+            _apply_update(docs[0], update, inserting=False)
+            return _Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = self._upsert_doc(query)
+            _apply_update(doc, update, inserting=True)
+            return _Result(matched_count=0, modified_count=0, upserted_id=self._insert(doc)["_id"])
+        return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def watch(self, pipeline=None, **kwargs):
+        # Like a standalone server: no change streams, so caches fall back to their TTL
+        from pymongo.errors import OperationFailure
+
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False):
+        docs = self._find(query)
+        if docs:
+            before = copy.deepcopy(docs[0])
+            _apply_update(docs[0], update, inserting=False)
+            return _project(docs[0] if return_document else before, projection)
+        if upsert:
+            doc = self._upsert_doc(query)
+            _apply_update(doc, update, inserting=True)
+            doc = self._insert(doc)
+            return _project(doc, projection) if return_document else None
+        return None
+
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name)
+        return self._collections[name]
+
+    async def command(self, name):
+        return {"ok": 1.0}
+
+
+def install_fake_mongo(db=None):
+    """Points the AsyncMongoDB singleton at `db`, by default a fresh in-memory database."""
+    from mongodb import AsyncMongoDB
+
+    AsyncMongoDB._instance = object.__new__(AsyncMongoDB)
+    AsyncMongoDB._client = None
+    AsyncMongoDB._db = db if db is not None else FakeDatabase()
+    return AsyncMongoDB._db
+
+
+# --- Local JWT issuer ---------------------------------------------------------------
+
+def _b64url_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+class LocalAuth:
+    """
+    Signs RS256 access tokens the way Auth0 would for this API and serves the matching
+    JWKS over HTTP, so the real verification path (JWKS cache included) is exercised.
+    """
+
+    def __init__(self, domain=BENCH_DOMAIN, audience=BENCH_AUDIENCE, kid="bench-key"):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        numbers = key.public_key().public_numbers()
+        self.jwks = {"keys": [{
+            "kty": "RSA",
+            "kid": kid,
+            "use": "sig",
+            "alg": "RS256",
+            "n": _b64url_uint(numbers.n),
+            "e": _b64url_uint(numbers.e),
+        }]}
+        self.server = None
+
+    def serve_jwks(self):
+        """Starts a background HTTP server for the JWKS and returns its URL."""
+        body = json.dumps(self.jwks).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "public, max-age=600")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/.well-known/jwks.json"
+
+    def token(self, sub, ttl=3600):
+        from jose import jwt
+
+        now = int(time.time())
+        claims = {
+            "sub": sub,
+            "iss": f"https://{self.domain}/",
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + ttl,
+        }
+        return jwt.encode(claims, self.private_pem, algorithm="RS256", headers={"kid": self.kid})
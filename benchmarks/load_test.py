@@ -0,0 +1,157 @@
+"""
+Offline load test for the FastAPI app.
+
+Every external dependency is replaced by a local stand-in (see fakes.py), the app's
+lifespan runs as in production, and requests are driven through the ASGI interface
+at a configurable concurrency. Reports p50/p95/p99 latency and throughput per endpoint.
+
+Usage:
+    python -m benchmarks.load_test --endpoints chat,user-info --requests 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks import fakes
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(endpoint, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+async def call(client, endpoint, token, i):
+    headers = {"Authorization": f"Bearer {token}"}
+    if endpoint == "user-info":
+        return await client.get("/api/user-info", headers=headers)
+    if endpoint == "select-character":
+        return await client.post("/api/select-character", json={"character": "girl" if i % 2 else "boy"}, headers=headers)
+    if endpoint == "chat":
+        return await client.post("/api/chat", json={"message": f"How do I cope with stress? ({i % 7})"}, headers=headers)
+    if endpoint == "chat-stream":
+        async with client.stream("POST", "/api/chat/stream", json={"message": f"I can't sleep ({i % 7})"}, headers=headers) as response:
+            async for _ in response.aiter_bytes():
+                pass
+            return response
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+async def drive(client, endpoint, tokens, requests, concurrency):
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                response = await call(client, endpoint, tokens[i % len(tokens)], i)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run(args):
+    fakes.configure_environment()
+
+    # App modules read the environment at import time
+    import httpx
+    import auth
+    import main
+    from conversation import Conversation
+    from embeddings import CachedEmbeddings, get_base_embedding_model
+    from retriever import Retriever
+
+    local_auth = fakes.LocalAuth()
+    auth.jwks_cache.jwks_url = local_auth.serve_jwks()
+    db = fakes.install_fake_mongo()
+
+    embeddings = get_base_embedding_model() if args.real_embeddings else fakes.HashEmbeddings()
+    qdrant_client, async_qdrant_client, seed = fakes.seeded_qdrant_clients(fakes.sample_chunks(args.chunks), embeddings)
+    await seed()
+    llm = fakes.FakeChatModel(latency=args.llm_latency, tokens_per_second=args.llm_tokens_per_second)
+
+    main.build_conversation = lambda: Conversation(
+        retriever=Retriever(
+            qdrant_client=qdrant_client,
+            async_qdrant_client=async_qdrant_client,
+            embedding_model=CachedEmbeddings(embeddings),
+        ),
+        llm=llm,
+    )
+
+    # Every benchmark user has a profile, so /api/user-info doesn't 404
+    user_ids = [f"auth0|bench-{i}" for i in range(args.users)]
+    for user_id in user_ids:
+        await db["users"].insert_one({"auth0_id": user_id, "email": f"{user_id}@bench.local", "selected_character": "girl"})
+    tokens = [local_auth.token(user_id) for user_id in user_ids]
+
+    results = []
+    async with main.lifespan(main.app):
+        while main.app.state.conversation is None:
+            await asyncio.sleep(0.05)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for endpoint in args.endpoints:
+                # Warm caches (JWKS, token cache, embeddings) outside the measurement
+                await drive(client, endpoint, tokens, min(args.users, args.requests), args.concurrency)
+                latencies, errors, elapsed = await drive(client, endpoint, tokens, args.requests, args.concurrency)
+                results.append(summarize(endpoint, latencies, errors, elapsed))
+
+    return results
+
+
+def print_report(results):
+    print(f"{'endpoint':<18}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for r in results:
+        print(f"{r['endpoint']:<18}{r['requests']:>10}{r['errors']:>8}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['throughput_rps']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the chat API with local stand-ins.")
+    parser.add_argument("--endpoints", default="user-info,select-character,chat,chat-stream",
+                        type=lambda value: value.split(","), help="Comma-separated endpoints to drive.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint.")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50, help="Distinct users (and tokens).")
+    parser.add_argument("--chunks", type=int, default=500, help="Sample chunks seeded into Qdrant.")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Fake LLM time to first token (s).")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the real embedding model.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Micro-benchmarks for the hot pieces of the chat path: message (de)serialization,
+retrieval (Qdrant and the local snapshot backend) and ingestion throughput.
+
+Usage:
+    python -m benchmarks.micro [--only serialization,retrieval,packing,ingestion] [--real-embeddings]
+"""
+import argparse
+import random
+import tempfile
+import time
+import timeit
+
+from benchmarks import fakes
+
+
+def best_per_op(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def _window(history, token_budget):
+    # Same walk as HistoryCompactor.compact: newest first until the budget is spent
+    from tokens import estimate_message_tokens
+    used, kept = 0, []
+    for message in reversed(history):
+        used += estimate_message_tokens(message)
+        if used > token_budget:
+            break
+        kept.append(message)
+    return kept
+
+
+def _chat_text(seed, chars):
+    # Varied text: the sample sentences in a different order per message. Sizes stay
+    # below their total length, so compression isn't measuring repeated text
+    sentences = list(fakes.SAMPLE_TEXTS)
+    random.Random(seed).shuffle(sentences)
+    return " ".join(sentences)[:chars]
+
+
+def bench_serialization(messages=40, token_budget=2000):
+    import bson
+    from langchain_core.messages import AIMessage, HumanMessage
+    from chat_message import COMPRESSION_ENABLED, LazyHistory, deserialize_message, serialize_message
+
+    print(f"serialization: {messages}-message window, compression {'on' if COMPRESSION_ENABLED else 'off'}")
+    print(f"  {'content':>8} {'format':<8}{'text B/msg':>11}{'stored B/msg':>13}{'ser us/msg':>12}{'deser us/msg':>14}{'window ms':>11}")
+    for content_chars in (80, 400, 1200):
+        history = [
+            (AIMessage if i % 2 else HumanMessage)(content=_chat_text(i, content_chars))
+            for i in range(messages)
+        ]
+        text_bytes = sum(len(message.content.encode("utf-8")) for message in history)
+
+        for fmt, compact in (("legacy", False), ("compact", True)):
+            serialized = [serialize_message(message, compact=compact) for message in history]
+            stored_bytes = sum(len(bson.encode(doc)) for doc in serialized)
+            serialize = best_per_op(lambda: [serialize_message(m, compact=compact) for m in history], number=20)
+            deserialize = best_per_op(lambda: [deserialize_message(d) for d in serialized], number=20)
+            # Prompt-window cost as the chat endpoint pays it: eager for legacy, lazy for compact
+            if compact:
+                window = best_per_op(lambda: _window(LazyHistory(serialized), token_budget), number=20)
+            else:
+                window = best_per_op(lambda: _window([deserialize_message(d) for d in serialized], token_budget), number=20)
+            print(f"  {content_chars:>8} {fmt:<8}{text_bytes / messages:>11.1f}{stored_bytes / messages:>13.1f}"
+                  f"{serialize / messages * 1e6:>12.2f}{deserialize / messages * 1e6:>14.2f}{window * 1e3:>11.3f}")
+
+
+def bench_retrieval(embeddings, chunks=2000, queries=200):
+    from retriever import Retriever
+    from vector_snapshot import LocalVectorIndex, export_snapshot
+
+    client, _, _ = fakes.seeded_qdrant_clients(fakes.sample_chunks(chunks), embeddings)
+    retriever = Retriever(qdrant_client=client, async_qdrant_client=object(), embedding_model=embeddings)
+    questions = [f"{fakes.SAMPLE_TEXTS[i % len(fakes.SAMPLE_TEXTS)]} ({i})" for i in range(queries)]
+    vectors = embeddings.embed_documents(questions)
+
+    def qdrant_search():
+        for vector in vectors:
+            client.query_points(fakes.BENCH_COLLECTION, query=vector, limit=5, score_threshold=0.6)
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        export_snapshot(client, fakes.BENCH_COLLECTION, snapshot_dir)
+        index = LocalVectorIndex(snapshot_dir)
+
+        def local_search():
+            for vector in vectors:
+                index.search(vector, 5, 0.6)
+
+        embed = best_per_op(lambda: embeddings.embed_documents(questions), number=1, repeat=3)
+        end_to_end = best_per_op(lambda: [retriever.search(q) for q in questions], number=1, repeat=3)
+        qdrant = best_per_op(qdrant_search, number=1, repeat=3)
+        local = best_per_op(local_search, number=1, repeat=3)
+
+    print(f"retrieval: {chunks} chunks, {queries} queries")
+    print(f"  embed query           {embed / queries * 1e3:8.3f} ms/query")
+    print(f"  Retriever.search      {end_to_end / queries * 1e3:8.3f} ms/query")
+    print(f"  in-memory Qdrant      {qdrant / queries * 1e3:8.3f} ms/query (search only)")
+    print(f"  local snapshot index  {local / queries * 1e3:8.3f} ms/query (search only)")
+
+
+def bench_packing(embeddings, chunks=2000, queries=200, fetch_k=12):
+    from context_packing import get_context_packer
+    from retriever import Retriever
+    from tokens import estimate_tokens
+
+    # Overlapping chunks, as the ingest splitter produces them
+    text = " ".join(fakes.sample_chunks(chunks // 4))
+    step, size = 400, 500
+    overlapping = [text[start:start + size] for start in range(0, len(text) - size, step)][:chunks]
+
+    client, _, _ = fakes.seeded_qdrant_clients(overlapping, embeddings)
+    retriever = Retriever(qdrant_client=client, async_qdrant_client=object(), embedding_model=embeddings)
+    packer = get_context_packer()
+    questions = [f"{fakes.SAMPLE_TEXTS[i % len(fakes.SAMPLE_TEXTS)]} ({i})" for i in range(queries)]
+    results = [retriever.search(q, top_k=fetch_k, score_threshold=0.0, with_vectors=True) for q in questions]
+
+    baseline = sum(estimate_tokens(doc.page_content) for docs in results for doc in docs[:packer.top_k])
+    packed = [packer.pack(docs) for docs in results]
+    packed_tokens = sum(estimate_tokens(doc.page_content) for docs in packed for doc in docs)
+    elapsed = best_per_op(lambda: [packer.pack(docs) for docs in results], number=1, repeat=3)
+
+    print(f"context packing: {len(overlapping)} overlapping chunks, fetch_k {fetch_k}, budget {packer.token_budget} tokens")
+    print(f"  top-{packer.top_k} context   {baseline / queries:8.1f} tokens/query")
+    print(f"  packed context  {packed_tokens / queries:8.1f} tokens/query")
+    print(f"  pack time       {elapsed / queries * 1e6:8.1f} us/query")
+
+
+def bench_ingestion(embeddings, chunks=2000, batch_size=64):
+    from qdrant_client import QdrantClient
+    from ingestor import Ingestor
+
+    texts = fakes.sample_chunks(chunks)
+    with tempfile.TemporaryDirectory() as folder:
+        ingestor = Ingestor(folder, embed_batch_size=batch_size, qdrant_client=QdrantClient(":memory:"), embedding_model=embeddings)
+        started = time.perf_counter()
+        ingestor._ingest_chunks("bench.pdf", [(i // 4, i % 4, text) for i, text in enumerate(texts)])
+        elapsed = time.perf_counter() - started
+
+    print(f"ingestion: {chunks} chunks, embed batch {batch_size}")
+    print(f"  throughput  {chunks / elapsed:8.1f} chunks/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for serialization, retrieval and ingestion.")
+    parser.add_argument("--only", default="serialization,retrieval,packing,ingestion", type=lambda value: value.split(","))
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the real embedding model.")
+    args = parser.parse_args()
+
+    fakes.configure_environment()
+    if args.real_embeddings:
+        from embeddings import get_base_embedding_model
+        embeddings = get_base_embedding_model()
+    else:
+        embeddings = fakes.HashEmbeddings()
+
+    if "serialization" in args.only:
+        bench_serialization()
+    if "retrieval" in args.only:
+        bench_retrieval(embeddings, chunks=args.chunks)
+    if "packing" in args.only:
+        bench_packing(embeddings, chunks=args.chunks)
+    if "ingestion" in args.only:
+        bench_ingestion(embeddings, chunks=args.chunks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+The FastAPI app wired to the local stand-ins of fakes.py, for running under serve.py:
+
+    BENCH_TOKENS_FILE=/tmp/tokens.json python serve.py --app benchmarks.offline_app:app
+
+Everything is set up at import, i.e. in the serve.py parent before the workers are
+forked, so every worker starts from the same seeded data. Each worker then has its own
+copy of the in-memory Mongo and Qdrant; writes are not shared between workers.
+Access tokens for the seeded users are written to BENCH_TOKENS_FILE.
+"""
+import os
+import asyncio
+import json
+
+from benchmarks import fakes
+
+fakes.configure_environment()
+
+# App modules read the environment at import time
+import auth  # noqa: E402
+import main  # noqa: E402
+from conversation import Conversation  # noqa: E402
+from embeddings import CachedEmbeddings, get_base_embedding_model  # noqa: E402
+from retriever import Retriever  # noqa: E402
+
+USERS = int(os.getenv("BENCH_USERS", "50"))
+CHUNKS = int(os.getenv("BENCH_CHUNKS", "500"))
+
+local_auth = fakes.LocalAuth()
+# The JWKS server thread stays in the parent; workers fetch the keys from it over HTTP
+auth.jwks_cache.jwks_url = local_auth.serve_jwks()
+
+db = fakes.install_fake_mongo()
+# mongodb.py drops its clients in forked workers; point them back at the in-memory copy
+os.register_at_fork(after_in_child=lambda: fakes.install_fake_mongo(db))
+
+embeddings = get_base_embedding_model() if os.getenv("BENCH_REAL_EMBEDDINGS", "false").lower() == "true" else fakes.HashEmbeddings()
+qdrant_client, async_qdrant_client, seed = fakes.seeded_qdrant_clients(fakes.sample_chunks(CHUNKS), embeddings)
+llm = fakes.FakeChatModel(
+    latency=float(os.getenv("BENCH_LLM_LATENCY", "0.3")),
+    tokens_per_second=float(os.getenv("BENCH_LLM_TOKENS_PER_SECOND", "200")),
+)
+
+main.build_conversation = lambda: Conversation(
+    retriever=Retriever(
+        qdrant_client=qdrant_client,
+        async_qdrant_client=async_qdrant_client,
+        embedding_model=CachedEmbeddings(embeddings),
+    ),
+    llm=llm,
+)
+
+
+async def _seed_users(user_ids):
+    await seed()
+    for user_id in user_ids:
+        await db["users"].insert_one({"auth0_id": user_id, "email": f"{user_id}@bench.local", "selected_character": "girl"})
+
+
+_user_ids = [f"auth0|bench-{i}" for i in range(USERS)]
+asyncio.run(_seed_users(_user_ids))
+
+if os.getenv("BENCH_TOKENS_FILE"):
+    with open(os.environ["BENCH_TOKENS_FILE"], "w") as f:
+        json.dump([local_auth.token(user_id) for user_id in _user_ids], f)
+
+app = main.app
@@ -0,0 +1,137 @@
+"""
+Recall-vs-latency report for the Qdrant collection profiles in qdrant_profiles.py.
+
+Exact top-k results from the in-memory Qdrant client (a brute-force scan) are the
+ground truth. Each profile is then built as a scratch collection on a real Qdrant
+server, where HNSW and int8 quantization actually apply, and searched at several
+`hnsw_ef` values.
+
+Usage:
+    python -m benchmarks.recall_report --url http://localhost:6333 --points 20000 --ef 16,32,64,128
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks import fakes
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def wait_until_indexed(client, collection_name, timeout=600):
+    # Optimization (HNSW build, quantization) runs asynchronously after the upload
+    from qdrant_client.models import CollectionStatus
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = client.get_collection(collection_name)
+        if info.status == CollectionStatus.GREEN and (info.indexed_vectors_count or 0) >= (info.points_count or 0):
+            return
+        time.sleep(0.5)
+    raise TimeoutError(f"{collection_name} was not indexed within {timeout}s")
+
+
+def measure(client, collection_name, queries, truth, top_k, params, query_filter=None):
+    latencies, hits = [], 0
+    for vector, expected in zip(queries, truth):
+        started = time.perf_counter()
+        response = client.query_points(
+            collection_name, query=vector, limit=top_k, search_params=params, query_filter=query_filter,
+        )
+        latencies.append(time.perf_counter() - started)
+        hits += len(expected & {point.id for point in response.points})
+    latencies.sort()
+    return {
+        "recall": hits / max(1, sum(len(expected) for expected in truth)),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+    }
+
+
+def run(args):
+    from qdrant_client import QdrantClient
+    from qdrant_client.models import HnswConfigDiff, OptimizersConfigDiff, SearchParams
+    from qdrant_profiles import PROFILES, build_filter, create_collection, search_params
+
+    if args.real_embeddings:
+        from embeddings import get_base_embedding_model
+        embeddings = get_base_embedding_model()
+    else:
+        embeddings = fakes.HashEmbeddings()
+
+    points = fakes.sample_points(fakes.sample_chunks(args.points), embeddings)
+    queries = embeddings.embed_documents([f"{fakes.SAMPLE_TEXTS[i % len(fakes.SAMPLE_TEXTS)]} (q{i})" for i in range(args.queries)])
+    query_filter = build_filter({"page": list(range(0, args.points // 4, 10))}) if args.filtered else None
+
+    # Ground truth: exact search in memory
+    exact = QdrantClient(":memory:")
+    exact_collection = "recall_truth"
+    create_collection(exact, exact_collection, PROFILES["default"], vector_size=len(points[0].vector))
+    exact.upload_points(exact_collection, points=points, wait=True)
+    truth = [
+        {point.id for point in exact.query_points(exact_collection, query=vector, limit=args.top_k, query_filter=query_filter).points}
+        for vector in queries
+    ]
+
+    server = QdrantClient(url=args.url, api_key=os.getenv("QDRANT_API_KEY"), timeout=60)
+    rows = []
+    for name in args.profiles:
+        profile = PROFILES[name]
+        collection_name = f"recall_report_{name}"
+        if server.collection_exists(collection_name):
+            server.delete_collection(collection_name)
+        create_collection(server, collection_name, profile, vector_size=len(points[0].vector))
+        # Build the HNSW graph even for small benchmark corpora, which Qdrant would otherwise full-scan
+        server.update_collection(
+            collection_name,
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=1),
+            hnsw_config=HnswConfigDiff(full_scan_threshold=1),
+        )
+        try:
+            server.upload_points(collection_name, points=points, batch_size=256, wait=True)
+            wait_until_indexed(server, collection_name)
+
+            rows.append({"profile": name, "hnsw_ef": "exact",
+                         **measure(server, collection_name, queries, truth, args.top_k, SearchParams(exact=True), query_filter)})
+            for ef in args.ef:
+                params = search_params(profile, ef)
+                rows.append({"profile": name, "hnsw_ef": ef,
+                             **measure(server, collection_name, queries, truth, args.top_k, params, query_filter)})
+        finally:
+            if not args.keep:
+                server.delete_collection(collection_name)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the Qdrant collection profiles.")
+    parser.add_argument("--url", default=os.getenv("QDRANT_URL", "http://localhost:6333"), help="Qdrant server to build the profiles on.")
+    parser.add_argument("--profiles", default=",".join(["default", "balanced", "low_memory", "high_recall"]),
+                        type=lambda value: value.split(","))
+    parser.add_argument("--ef", default="16,32,64,128", type=lambda value: [int(v) for v in value.split(",")])
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--filtered", action="store_true", help="Restrict searches with a payload filter on page.")
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the real embedding model.")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch collections.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    fakes.configure_environment()
+    rows = run(args)
+
+    print(f"{'profile':<14}{'hnsw_ef':>8}{'recall@' + str(args.top_k):>11}{'p50 ms':>9}{'p95 ms':>9}")
+    for row in rows:
+        print(f"{row['profile']:<14}{str(row['hnsw_ef']):>8}{row['recall']:>11.3f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
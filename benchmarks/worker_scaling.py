@@ -0,0 +1,138 @@
+"""
+Memory and throughput of serve.py as the worker count grows.
+
+For each worker count, serve.py is started with the offline app (see offline_app.py),
+driven over real HTTP at a fixed concurrency, and the memory of the parent and every
+worker is read from /proc/<pid>/smaps_rollup (Linux only) once the load has run.
+PSS splits shared pages between the processes mapping them, so the total PSS is what
+the server really costs; a worker's private memory is what one more worker adds.
+
+Usage:
+    python -m benchmarks.worker_scaling --workers 1,2,4 --endpoint chat --requests 400 --concurrency 32
+"""
+import os
+import argparse
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.load_test import drive, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def memory_kb(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def child_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+async def wait_until_serving(client, process, workers, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with status {process.returncode}")
+        try:
+            response = await client.get("/readyz")
+            if response.status_code == 200 and len(child_pids(process.pid)) == workers:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"serve.py with {workers} workers was not ready after {timeout}s")
+
+
+async def measure(args, workers):
+    import httpx
+
+    tokens_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
+    env = dict(os.environ, BENCH_TOKENS_FILE=tokens_file, BENCH_USERS=str(args.users), BENCH_CHUNKS=str(args.chunks),
+               BENCH_LLM_LATENCY=str(args.llm_latency), BENCH_REAL_EMBEDDINGS=str(args.real_embeddings).lower(),
+               PRELOAD_EMBEDDINGS=str(args.real_embeddings).lower())
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    process = subprocess.Popen(
+        [sys.executable, "serve.py", "--app", "benchmarks.offline_app:app", "--host", "127.0.0.1",
+         "--port", str(args.port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=None) as client:
+            await wait_until_serving(client, process, workers, args.startup_timeout)
+            with open(tokens_file) as f:
+                tokens = json.load(f)
+
+            # Warm every worker's caches (JWKS, token cache, embeddings) outside the measurement
+            await drive(client, args.endpoint, tokens, max(args.users, workers * 10), args.concurrency)
+            latencies, errors, elapsed = await drive(client, args.endpoint, tokens, args.requests, args.concurrency)
+
+        parent = memory_kb(process.pid)
+        children = [memory_kb(pid) for pid in child_pids(process.pid)]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+        os.unlink(tokens_file)
+
+    result = summarize(args.endpoint, latencies, errors, elapsed)
+    result.update({
+        "workers": workers,
+        "parent_rss_mb": parent["rss"] / 1024,
+        "worker_rss_mb": sum(child["rss"] for child in children) / len(children) / 1024,
+        "worker_private_mb": sum(child["private"] for child in children) / len(children) / 1024,
+        "total_pss_mb": (parent["pss"] + sum(child["pss"] for child in children)) / 1024,
+    })
+    return result
+
+
+def print_report(results):
+    print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}"
+          f"{'parent RSS':>12}{'worker RSS':>12}{'private':>10}{'total PSS':>11}")
+    for r in results:
+        print(f"{r['workers']:>8}{r['throughput_rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['errors']:>8}"
+              f"{r['parent_rss_mb']:>10.0f}MB{r['worker_rss_mb']:>10.0f}MB{r['worker_private_mb']:>8.0f}MB{r['total_pss_mb']:>9.0f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and throughput of serve.py per worker count.")
+    parser.add_argument("--workers", default="1,2,4", type=lambda value: [int(n) for n in value.split(",")],
+                        help="Comma-separated worker counts to measure.")
+    parser.add_argument("--endpoint", default="chat", help="Endpoint to drive (see load_test.py).")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=50, help="Distinct users (and tokens).")
+    parser.add_argument("--chunks", type=int, default=500, help="Sample chunks seeded into Qdrant.")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Fake LLM time to first token (s).")
+    parser.add_argument("--real-embeddings", action="store_true", help="Use (and preload) the real embedding model.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+    if args.endpoint not in ("user-info", "select-character", "chat", "chat-stream"):
+        parser.error(f"unknown endpoint: {args.endpoint}")
+
+    results = [asyncio.run(measure(args, workers)) for workers in args.workers]
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,111 @@
+import os
+from collections.abc import Sequence
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
-def serialize_message(message):
+# zstandard is optional; without it long messages are stored uncompressed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Stored message schema:
+#   legacy (no "v"): {"role", "content", "additional_kwargs", "response_metadata"}
+#   v2: {"v": 2, "r": role code, "c": content or "z": zstd-compressed content,
+#        "k": additional_kwargs, "m": response_metadata}, empty fields omitted
+SCHEMA_VERSION = 2
+COMPRESSION_MIN_BYTES = int(os.getenv("MESSAGE_COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_ENABLED = os.getenv("MESSAGE_COMPRESSION", "true").lower() == "true" and zstandard is not None
+
+MESSAGE_TYPES = {"human": HumanMessage, "system": SystemMessage, "ai": AIMessage}
+ROLE_CODES = {"human": "h", "system": "s", "ai": "a"}
+CODE_ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+# zstd contexts aren't thread-safe, so they're created per call; creation is cheap
+# compared to the Mongo round trip around it
+def _compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+def _decompress(data: bytes) -> bytes:
+    if zstandard is None:
+        raise RuntimeError("Message is zstd-compressed but the zstandard package is not installed")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+def _role(message):
+    for role, message_type in MESSAGE_TYPES.items():
+        if isinstance(message, message_type):
+            return role
+    raise TypeError(f"Cannot serialize message of type {type(message)}")
+
+def serialize_message(message, compact=True):
     """Convert a LangChain message object to a dictionary for MongoDB storage."""
-    if isinstance(message, HumanMessage):
-        return {
-            "role": "human",
-            "content": message.content,
-            "additional_kwargs": message.additional_kwargs,
-            "response_metadata": message.response_metadata,
-        }
-    elif isinstance(message, SystemMessage):
-        return {
-            "role": "system",
-            "content": message.content,
-            "additional_kwargs": message.additional_kwargs,
-            "response_metadata": message.response_metadata,
-        }
-    elif isinstance(message, AIMessage):
+    role = _role(message)
+    if not compact:
         return {
-            "role": "ai",
+            "role": role,
             "content": message.content,
             "additional_kwargs": message.additional_kwargs,
             "response_metadata": message.response_metadata,
         }
+
+    serialized = {"v": SCHEMA_VERSION, "r": ROLE_CODES[role]}
+    content = message.content
+    if COMPRESSION_ENABLED and isinstance(content, str) and len(content) >= COMPRESSION_MIN_BYTES:
+        serialized["z"] = _compress(content.encode("utf-8"))
     else:
-        raise TypeError(f"Cannot serialize message of type {type(message)}")
+        serialized["c"] = content
+    if message.additional_kwargs:
+        serialized["k"] = message.additional_kwargs
+    if message.response_metadata:
+        serialized["m"] = message.response_metadata
+    return serialized
 
 def deserialize_message(serialized_message):
     """Convert a dictionary back into a LangChain message object."""
-    role = serialized_message["role"]
-    content = serialized_message["content"]
-    additional_kwargs = serialized_message.get("additional_kwargs", {})
-    response_metadata = serialized_message.get("response_metadata", {})
-
-    if role == "human":
-        return HumanMessage(content=content, additional_kwargs=additional_kwargs, response_metadata=response_metadata)
-    elif role == "system":
-        return SystemMessage(content=content, additional_kwargs=additional_kwargs, response_metadata=response_metadata)
-    elif role == "ai":
-        return AIMessage(content=content, additional_kwargs=additional_kwargs, response_metadata=response_metadata)
+    if "v" in serialized_message:
+        role = CODE_ROLES.get(serialized_message["r"])
+        if "z" in serialized_message:
+            content = _decompress(serialized_message["z"]).decode("utf-8")
+        else:
+            content = serialized_message.get("c", "")
+        additional_kwargs = serialized_message.get("k", {})
+        response_metadata = serialized_message.get("m", {})
     else:
-        raise ValueError(f"Unknown role type: {role}")
\ No newline at end of file
+        role = serialized_message["role"]
+        content = serialized_message["content"]
+        additional_kwargs = serialized_message.get("additional_kwargs", {})
+        response_metadata = serialized_message.get("response_metadata", {})
+
+    message_type = MESSAGE_TYPES.get(role)
+    if message_type is None:
+        raise ValueError(f"Unknown role type: {role}")
+    return message_type(content=content, additional_kwargs=additional_kwargs, response_metadata=response_metadata)
+
+
+class LazyHistory(Sequence):
+    """
+    Read-only list of stored messages that builds each LangChain message on first access.
+
+    History compaction walks the window from the newest message and stops once the
+    prompt budget is spent, so older messages in the window are never built.
+
+    Args:
+        serialized_messages (list): Stored message documents, oldest first.
+    """
+
+    def __init__(self, serialized_messages):
+        self._serialized = serialized_messages
+        self._messages = [None] * len(serialized_messages)
+
+    def __len__(self):
+        return len(self._serialized)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        message = self._messages[index]
+        if message is None:
+            message = self._messages[index] = deserialize_message(self._serialized[index])
+        return message
+
+    def __repr__(self):
+        return f"LazyHistory({len(self)} messages)"
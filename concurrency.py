@@ -0,0 +1,102 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class KeyedLocks:
+    """
+    One asyncio.Lock per key (e.g. per user), so work for the same key runs one at a
+    time in arrival order. A key's lock is dropped once nobody holds or waits on it.
+    """
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, holders and waiters]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many requests in flight")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps concurrent work at `max_concurrent`, with a bounded wait queue.
+
+    A request is rejected immediately when `max_queue` requests are already waiting,
+    and after `max_wait` seconds if no slot frees up; callers turn `Overloaded` into
+    a 503 with Retry-After.
+    """
+
+    def __init__(self, max_concurrent=16, max_queue=64, max_wait=10.0, retry_after=2):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def check(self):
+        # Fast rejection without taking a slot, for callers that acquire later
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.retry_after)
+
+    @asynccontextmanager
+    async def slot(self):
+        self.check()
+
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self.retry_after)
+        finally:
+            self.waiting -= 1
+
+        wait = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait_seen = max(self.max_wait_seen, wait)
+
+        self.active += 1
+        try:
+            yield wait
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_seconds": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait_seconds": self.max_wait_seen,
+        }
@@ -0,0 +1,174 @@
+import os
+import re
+import logging
+import numpy as np
+from langchain_core.documents import Document
+from telemetry import record_tokens
+from tokens import estimate_tokens
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+VECTOR_METADATA_KEY = "_vector"
+
+# Overlap looked for between adjacent chunks; the ingest splitter uses up to 100 characters.
+# Shorter suffix/prefix matches are coincidences (a shared "." or letter), not overlap
+MAX_CHUNK_OVERLAP = 300
+MIN_CHUNK_OVERLAP = 20
+
+_WORD = re.compile(r"\w+")
+
+
+def _overlap(left, right, max_overlap=MAX_CHUNK_OVERLAP, min_overlap=MIN_CHUNK_OVERLAP):
+    # Length of the longest suffix of `left` that is also a prefix of `right`, or 0 if
+    # it is shorter than `min_overlap`
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ContextPacker:
+    """
+    Post-retrieval stage that turns over-fetched search results into the context sent
+    to the model.
+
+    1. Adjacent chunks of the same source/page are merged, with their shared overlap
+       kept only once.
+    2. Maximal marginal relevance (MMR) picks up to `top_k` results, trading score
+       against similarity to results already picked; candidates at least
+       `duplicate_threshold` similar to a pick are dropped outright. Similarity uses
+       the point vectors when the search returned them, otherwise word overlap.
+    3. The picks are packed by score into `token_budget` estimated tokens.
+
+    Args:
+        top_k (int): Maximum documents in the packed context.
+        token_budget (int): Maximum estimated tokens of packed document text.
+        mmr_lambda (float): 1.0 ranks by score only; lower values favour diversity.
+        duplicate_threshold (float): Similarity at which a candidate counts as a duplicate.
+    """
+
+    def __init__(self, top_k=5, token_budget=1200, mmr_lambda=0.7, duplicate_threshold=0.95):
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+
+    def pack(self, docs):
+        """
+        Returns the packed documents, best first. Vectors attached by the search are
+        removed from the metadata of every input document.
+        """
+        docs = [self._with_vector(doc) for doc in docs]
+        if not docs:
+            return []
+
+        # What the plain top-k search would have sent, for the savings metric
+        by_score = sorted(docs, key=lambda item: item[0].metadata.get("_score", 0), reverse=True)
+        baseline_tokens = sum(estimate_tokens(doc.page_content) for doc, _ in by_score[:self.top_k])
+
+        selected = self._mmr(self._merge_adjacent(docs))
+
+        packed, used = [], 0
+        for doc, _ in selected:
+            cost = estimate_tokens(doc.page_content)
+            if packed and used + cost > self.token_budget:
+                continue
+            packed.append(doc)
+            used += cost
+
+        saved = max(0, baseline_tokens - used)
+        record_tokens("context", used)
+        record_tokens("context_saved", saved)
+        logging.debug(f"Packed {len(docs)} retrieved chunks into {len(packed)} documents, {used} tokens ({saved} saved)")
+        return packed
+
+    @staticmethod
+    def _with_vector(doc):
+        metadata = dict(doc.metadata)
+        vector = metadata.pop(VECTOR_METADATA_KEY, None)
+        doc = Document(page_content=doc.page_content, metadata=metadata)
+        return doc, (_unit(vector) if vector is not None else None)
+
+    def _merge_adjacent(self, docs):
+        # Runs of consecutive chunk indexes within one source/page become one document
+        groups, loose = {}, []
+        for doc, vector in docs:
+            metadata = doc.metadata
+            if metadata.get("source") is None or metadata.get("page") is None or metadata.get("chunk") is None:
+                loose.append((doc, vector))
+                continue
+            groups.setdefault((metadata["source"], metadata["page"]), []).append((doc, vector))
+
+        merged = list(loose)
+        for parts in groups.values():
+            parts.sort(key=lambda item: item[0].metadata["chunk"])
+            run = [parts[0]]
+            for part in parts[1:]:
+                if part[0].metadata["chunk"] == run[-1][0].metadata["chunk"] + 1:
+                    run.append(part)
+                else:
+                    merged.append(self._merge_run(run))
+                    run = [part]
+            merged.append(self._merge_run(run))
+        return merged
+
+    @staticmethod
+    def _merge_run(run):
+        if len(run) == 1:
+            return run[0]
+        text = run[0][0].page_content
+        for doc, _ in run[1:]:
+            overlap = _overlap(text, doc.page_content)
+            # Without an overlap the splitter cut at a separator, which it stripped
+            text += doc.page_content[overlap:] if overlap else " " + doc.page_content
+
+        best = max(run, key=lambda item: item[0].metadata.get("_score", 0))[0]
+        metadata = dict(best.metadata)
+        metadata["chunks"] = [doc.metadata["chunk"] for doc, _ in run]
+        metadata["_ids"] = [doc.metadata.get("_id") for doc, _ in run]
+
+        vectors = [vector for _, vector in run]
+        vector = _unit(np.mean(vectors, axis=0)) if all(v is not None for v in vectors) else None
+        return Document(page_content=text, metadata=metadata), vector
+
+    def _mmr(self, candidates):
+        use_vectors = all(vector is not None for _, vector in candidates)
+        words = None if use_vectors else [set(_WORD.findall(doc.page_content.lower())) for doc, _ in candidates]
+
+        def similarity(i, j):
+            if use_vectors:
+                return float(candidates[i][1] @ candidates[j][1])
+            union = words[i] | words[j]
+            return len(words[i] & words[j]) / len(union) if union else 0.0
+
+        scores = [doc.metadata.get("_score", 0) for doc, _ in candidates]
+        remaining = list(range(len(candidates)))
+        redundancy = [0.0] * len(candidates)  # max similarity to any pick so far
+        picked = []
+        while remaining and len(picked) < self.top_k:
+            best = max(remaining, key=lambda i: self.mmr_lambda * scores[i] - (1 - self.mmr_lambda) * redundancy[i])
+            picked.append(best)
+            remaining.remove(best)
+            for i in remaining:
+                redundancy[i] = max(redundancy[i], similarity(i, best))
+            remaining = [i for i in remaining if redundancy[i] < self.duplicate_threshold]
+
+        # Packing goes by relevance, not by MMR pick order
+        picked.sort(key=lambda i: scores[i], reverse=True)
+        return [candidates[i] for i in picked]
+
+
+def get_context_packer():
+    return ContextPacker(
+        top_k=int(os.getenv("RETRIEVAL_TOP_K", "5")),
+        token_budget=int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1200")),
+        mmr_lambda=float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7")),
+        duplicate_threshold=float(os.getenv("RETRIEVAL_DUPLICATE_THRESHOLD", "0.95")),
+    )
@@ -1,14 +1,22 @@
 import os
+import asyncio
+import time
 from dotenv import load_dotenv
 import logging
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_anthropic import ChatAnthropic
-from retriever import Retriever  # Import the existing Retriever class
-
-from langchain_aws import ChatBedrock
+from retriever import Retriever, merge_documents  # Import the existing Retriever class
+from history_compactor import HistoryCompactor
+from semantic_cache import SemanticAnswerCache
+from memory import ConversationMemory
+from context_packing import get_context_packer
+from telemetry import record_stage, record_tokens, stage
+from tokens import estimate_message_tokens, estimate_tokens
 
 
 # Load environment variables
@@ -18,23 +26,69 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class Conversation:
-    def __init__(self):
+    def __init__(self, retriever=None, llm=None, memory=None):
         # Initialize the Retriever instance
-        self.retriever = Retriever()  # This uses the existing Retriever class
+        self.retriever = retriever or Retriever()  # This uses the existing Retriever class
 
-        # Initialize the Claude model
-        self.llm = ChatAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), model="claude-3-sonnet-20240229")  # Use the Claude model
+        # Initialize the Claude model (benchmarks pass a stand-in)
+        self.llm = llm or ChatAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), model="claude-3-sonnet-20240229")  # Use the Claude model
 
         # Define prompt templates for question reformulation and answering
         self._setup_prompts()
 
+        # Keeps the histories passed to both prompts within their token budgets
+        self.compactor = HistoryCompactor(
+            self.llm,
+            keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "4")),
+            refresh_turns=int(os.getenv("HISTORY_REFRESH_TURNS", "4")),
+            contextualize_token_budget=int(os.getenv("CONTEXTUALIZE_HISTORY_TOKEN_BUDGET", "1000")),
+            qa_token_budget=int(os.getenv("QA_HISTORY_TOKEN_BUDGET", "2000")),
+        )
+        self._background_tasks = set()
+
+        # Optional long-term memory: past exchanges recalled by similarity to the new message
+        self.memory = memory
+        if self.memory is None and os.getenv("MEMORY_ENABLED", "false").lower() == "true":
+            self.memory = ConversationMemory(
+                qdrant_client=getattr(self.retriever, "qdrant_client", None),
+                async_qdrant_client=getattr(self.retriever, "async_qdrant_client", None),
+                embedding_model=self.retriever.embedding_model,
+                top_k=int(os.getenv("MEMORY_TOP_K", "3")),
+                score_threshold=float(os.getenv("MEMORY_SCORE_THRESHOLD", "0.5")),
+                token_budget=int(os.getenv("MEMORY_TOKEN_BUDGET", "600")),
+            )
+
+        # Opt-in semantic cache for answers to history-free (first-turn) questions
+        self.answer_cache = None
+        if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+            self.answer_cache = SemanticAnswerCache(
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+                ttl=int(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+                max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "1000")),
+            )
+
+        # Searches over-fetch RETRIEVAL_FETCH_K chunks; the packer de-duplicates, merges
+        # adjacent chunks and fits the result into the context token budget
+        self.fetch_k = int(os.getenv("RETRIEVAL_FETCH_K", "12"))
+        self.packer = get_context_packer()
+        self.context_retriever = self.retriever.get_retriever(top_k=self.fetch_k, with_vectors=True)
+
         # Create history-aware retriever and RAG chain
-        self.history_aware_retriever = create_history_aware_retriever(self.llm, self.retriever.get_retriever(), self.contextualize_q_prompt)
+        self.history_aware_retriever = create_history_aware_retriever(
+            self.llm, self.context_retriever | RunnableLambda(self._pack), self.contextualize_q_prompt
+        )
         # Chain to combine documents for answering
         self.question_answer_chain = create_stuff_documents_chain(self.llm, self.qa_prompt)
         
         self.rag_chain = create_retrieval_chain(self.history_aware_retriever, self.question_answer_chain)
 
+        # "chain" runs rephrase -> search -> answer serially, as rag_chain does;
+        # "speculative" overlaps the search on the raw message with the rephrase call
+        self.pipeline = os.getenv("CONVERSATION_PIPELINE", "chain")
+        self.rephrase_min_history = int(os.getenv("REPHRASE_MIN_HISTORY_MESSAGES", "2"))
+        self.rephrase_timeout = float(os.getenv("SPECULATIVE_REPHRASE_TIMEOUT", "3"))
+        self.rephrase_chain = self.contextualize_q_prompt | self.llm | StrOutputParser()
+
     def _setup_prompts(self):
         # Contextualize Question Prompt (Therapy Context)
         contextualize_q_template = """You are a supportive and thoughtful therapist assistant. Your task is to rephrase the user’s latest question 
@@ -42,14 +96,14 @@ class Conversation:
         Do NOT answer the question; simply restate it in a compassionate and clear way.
 
         Chat History:
-        {chat_history}
+        {rephrase_history}
 
         Latest Question:
         {input}
 
         Rephrased Question:
         """
-        self.contextualize_q_prompt = PromptTemplate(template=contextualize_q_template, input_variables=["chat_history", "input"])
+        self.contextualize_q_prompt = PromptTemplate(template=contextualize_q_template, input_variables=["rephrase_history", "input"])
         #===============================================
         # Question-Answering Prompt (Therapy Context)
         qa_template = """You are a compassionate assistant for therapy support. Using the retrieved information, 
@@ -74,33 +128,240 @@ class Conversation:
 
         
 
-    def handle_message(self, user_message, chat_history):
+    async def warmup(self):
+        """
+        Run a dummy embed and search so the first real request doesn't pay for lazy
+        model initialization and connection setup.
+        """
+        started = time.perf_counter()
+        await self.retriever.asearch("warmup", top_k=1)
+        logging.info(f"Warmup finished in {time.perf_counter() - started:.2f}s")
+
+    def _chain_inputs(self, user_message, chat_history, summary=""):
+        # Each prompt gets its own compacted view of the history, within its own budget
+        return {
+            "input": user_message,
+            "chat_history": self.compactor.qa_history(chat_history, summary),
+            "rephrase_history": self.compactor.contextualize_history(chat_history, summary),
+        }
+
+    def schedule_history_refresh(self, user_id):
+        """
+        Refresh the user's rolling history summary in the background, off the response path.
+        """
+        self._run_in_background(self.compactor.refresh(user_id), "History summary refresh")
+
+    def remember_turn(self, user_id, user_message, assistant_response):
+        """
+        Store a completed exchange in the user's long-term memory in the background.
+        """
+        if self.memory is not None:
+            self._run_in_background(self.memory.remember(user_id, user_message, assistant_response), "Memory write")
+
+    def _run_in_background(self, coroutine, name):
+        task = asyncio.create_task(coroutine, name=name)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._on_background_task_done)
+
+    def _on_background_task_done(self, task):
+        self._background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"{task.get_name()} failed: {task.exception()}")
+
+    async def _arecall(self, user_id, inputs):
+        # Memory is best effort: a failed recall must not fail the turn
+        if self.memory is None or user_id is None:
+            return None
+        try:
+            in_prompt = [message.content for message in inputs["chat_history"] if isinstance(message, HumanMessage)]
+            return self.memory.to_message(await self.memory.recall(user_id, inputs["input"], in_prompt))
+        except Exception as e:
+            logging.warning(f"Memory recall failed: {e}")
+            return None
+
+    async def _aretrieve_with_memory(self, user_id, inputs):
+        # Documents and past exchanges are fetched concurrently; recalled exchanges go
+        # ahead of the recent turns in the answer prompt's history
+        docs, memory_message = await asyncio.gather(self._aretrieve(inputs), self._arecall(user_id, inputs))
+        if memory_message is not None:
+            inputs = {**inputs, "chat_history": [memory_message, *inputs["chat_history"]]}
+        return inputs, docs
+
+    def _is_cacheable(self, chat_history, summary):
+        # Answers that depend on earlier turns are never cached
+        return self.answer_cache is not None and not chat_history and not summary
+
+    async def _afirst_turn_context(self, user_message):
+        # With no history the chain wouldn't rephrase the question, so retrieve on it directly
+        vector = await self.retriever.embedding_model.aembed_query(user_message)
+        docs = self._pack(await self.context_retriever.ainvoke(user_message))
+        # Merged documents cover several chunks; the key includes every one of them
+        chunk_ids = [chunk_id for doc in docs for chunk_id in (doc.metadata.get("_ids") or [doc.metadata.get("_id")])]
+        return vector, docs, chunk_ids, self.answer_cache.lookup(vector, chunk_ids)
+
+    async def _aspeculative_retrieve(self, inputs):
+        """
+        Retrieve documents without putting the rephrase LLM call in front of the search.
+
+        With empty or trivially short history the raw message is searched directly.
+        Otherwise the raw-message search and the rephrase run concurrently; if the
+        rephrase doesn't arrive within `rephrase_timeout` the raw results are used,
+        else both result sets are merged by score.
+        """
+        retriever = self.context_retriever
+        user_message = inputs["input"]
+        if len(inputs["rephrase_history"]) <= self.rephrase_min_history:
+            return await retriever.ainvoke(user_message)
+
+        raw_search = asyncio.create_task(retriever.ainvoke(user_message))
+        try:
+            rephrased = await asyncio.wait_for(self._arephrase(inputs), self.rephrase_timeout)
+        except asyncio.TimeoutError:
+            logging.info("Rephrasing timed out, using results for the raw message")
+            return await raw_search
+        except Exception as e:
+            logging.warning(f"Rephrasing failed, using results for the raw message: {e}")
+            return await raw_search
+
+        if " ".join(rephrased.lower().split()) == " ".join(user_message.lower().split()):
+            return await raw_search
+        raw_docs, rephrased_docs = await asyncio.gather(raw_search, retriever.ainvoke(rephrased))
+        return merge_documents(rephrased_docs, raw_docs, top_k=retriever.top_k)
+
+    async def _arephrase(self, inputs):
+        with stage("rephrase"):
+            return await self.rephrase_chain.ainvoke(inputs)
+
+    def _pack(self, docs):
+        with stage("pack"):
+            return self.packer.pack(docs)
+
+    async def _aretrieve(self, inputs):
+        if self.pipeline == "speculative":
+            return self._pack(await self._aspeculative_retrieve(inputs))
+
+        # Same steps as the history-aware retriever in rag_chain, with the rephrase timed on its own
+        if not inputs["chat_history"]:
+            return self._pack(await self.context_retriever.ainvoke(inputs["input"]))
+        return self._pack(await self.context_retriever.ainvoke(await self._arephrase(inputs)))
+
+    def _record_token_usage(self, inputs, docs, assistant_response):
+        prompt_tokens = estimate_tokens(inputs["input"])
+        prompt_tokens += sum(estimate_message_tokens(message) for message in inputs["chat_history"])
+        prompt_tokens += sum(estimate_tokens(doc.page_content) for doc in docs)
+        record_tokens("prompt", prompt_tokens)
+        record_tokens("completion", estimate_tokens(assistant_response))
+
+    async def _astream_answer(self, inputs, docs):
+        # Streams the answer, timing the first token and the whole generation
+        started = time.perf_counter()
+        answer_parts = []
+        async for token in self.question_answer_chain.astream({**inputs, "context": docs}):
+            if not answer_parts:
+                record_stage("first_token", time.perf_counter() - started)
+            answer_parts.append(token)
+            yield token
+        record_stage("generate", time.perf_counter() - started)
+        self._record_token_usage(inputs, docs, "".join(answer_parts))
+
+    def handle_message(self, user_message, chat_history, summary=""):
         """
         Process a user's message with chat history using the RAG chain.
         
         Args:
             user_message (str): The user's message.
             chat_history (list): A list of previous messages.
+            summary (str): Rolling summary of the turns before `chat_history`.
         
         Returns:
             str: The assistant's response.
         """
-        logging.info(f"Handling user message: {user_message}")
-        logging.info(f"Handling user history message: {chat_history}")
+        logging.debug(f"Handling user message: {user_message}")
 
-        response = self.rag_chain.invoke({"input": user_message, "chat_history": chat_history})
-        print(response)
+        response = self.rag_chain.invoke(self._chain_inputs(user_message, chat_history, summary))
         
         # Extract and return the assistant's response
         assistant_response = response["answer"]
-        logging.info(f"Assistant response: {assistant_response}")
+        logging.debug(f"Assistant response: {assistant_response}")
         
         return assistant_response
     
+    async def ahandle_message(self, user_message, chat_history, summary="", user_id=None):
+        """
+        Async variant of `handle_message`, awaiting the RAG chain so the event loop
+        stays free while Claude and Qdrant respond.
+        
+        Args:
+            user_message (str): The user's message.
+            chat_history (list): A list of previous messages.
+            summary (str): Rolling summary of the turns before `chat_history`.
+            user_id (str): Whose long-term memory to recall from, if memory is enabled.
+        
+        Returns:
+            str: The assistant's response.
+        """
+        logging.debug(f"Handling user message: {user_message}")
+
+        if self._is_cacheable(chat_history, summary):
+            vector, docs, chunk_ids, cached_answer = await self._afirst_turn_context(user_message)
+            if cached_answer is not None:
+                logging.debug("Answered from the semantic cache")
+                return cached_answer
+            inputs = {"input": user_message, "chat_history": []}
+            with stage("generate"):
+                assistant_response = await self.question_answer_chain.ainvoke({**inputs, "context": docs})
+            self._record_token_usage(inputs, docs, assistant_response)
+            self.answer_cache.store(vector, chunk_ids, assistant_response)
+            return assistant_response
+
+        inputs, docs = await self._aretrieve_with_memory(user_id, self._chain_inputs(user_message, chat_history, summary))
+        with stage("generate"):
+            assistant_response = await self.question_answer_chain.ainvoke({**inputs, "context": docs})
+        self._record_token_usage(inputs, docs, assistant_response)
+        logging.debug(f"Assistant response: {assistant_response}")
+
+        return assistant_response
+    
+    async def astream_message(self, user_message, chat_history, summary="", user_id=None):
+        """
+        Stream the RAG chain's output for a user's message.
+
+        Cancelling the consuming task cancels the upstream LLM request.
+        
+        Args:
+            user_message (str): The user's message.
+            chat_history (list): A list of previous messages.
+            summary (str): Rolling summary of the turns before `chat_history`.
+            user_id (str): Whose long-term memory to recall from, if memory is enabled.
+        
+        Yields:
+            tuple: ("sources", list of retrieved document metadata) once retrieval
+            finishes, then ("token", str) for each chunk of the answer.
+        """
+        logging.debug(f"Streaming response for user message: {user_message}")
+
+        if self._is_cacheable(chat_history, summary):
+            vector, docs, chunk_ids, cached_answer = await self._afirst_turn_context(user_message)
+            yield "sources", [doc.metadata for doc in docs]
+            if cached_answer is not None:
+                yield "token", cached_answer
+                return
+            answer_parts = []
+            async for token in self._astream_answer({"input": user_message, "chat_history": []}, docs):
+                answer_parts.append(token)
+                yield "token", token
+            self.answer_cache.store(vector, chunk_ids, "".join(answer_parts))
+            return
+
+        inputs, docs = await self._aretrieve_with_memory(user_id, self._chain_inputs(user_message, chat_history, summary))
+        yield "sources", [doc.metadata for doc in docs]
+        async for token in self._astream_answer(inputs, docs):
+            yield "token", token
+    
     def reformulate_question(self, user_message, chat_history):
       # Format the reformulation prompt with chat history and user message
       reformulation_input = self.contextualize_q_prompt.format(
-          chat_history=chat_history,
+          rephrase_history=self.compactor.contextualize_history(chat_history, ""),
           input=user_message
       )
       
@@ -124,7 +385,7 @@ class Conversation:
         reformulated_question = self.reformulate_question(user_message, chat_history)
 
         # Step 2: Retrieve relevant documents based on the reformulated question
-        retrieved_docs = self.retriever.get_retriever().invoke(reformulated_question.content)
+        retrieved_docs = self._pack(self.context_retriever.invoke(reformulated_question.content))
 
         # Step 3: Pass the context and user input to the question-answering chain
         response = self.question_answer_chain.invoke({
@@ -0,0 +1,404 @@
+import os
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+# Load environment variables
+load_dotenv()
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "huggingface")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "models/all-MiniLM-L6-v2-onnx")
+ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "false").lower() == "true"
+
+# all-MiniLM-L6-v2's sentence-transformers max_seq_length
+MAX_SEQ_LENGTH = 256
+ONNX_FILENAME = "model.onnx"
+ONNX_INT8_FILENAME = "model.int8.onnx"
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches query vectors.
+
+    Vectors are kept in an in-memory LRU keyed by normalized text, with an optional
+    SQLite tier on disk that survives restarts. Concurrent async queries that arrive
+    within `batch_window_ms` of each other are embedded in a single forward pass.
+
+    Document embeddings (ingestion) are passed straight through, so a bulk load
+    doesn't evict the query working set.
+    """
+
+    def __init__(self, model, model_name=EMBEDDING_MODEL_NAME, max_entries=10000, disk_path=None,
+                 batch_window_ms=5, max_batch_size=32):
+        self.model = model
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_queries = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flush_handle = None
+        self._batch_tasks = set()
+
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self._disk.commit()
+            self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str):
+        # all-MiniLM-L6-v2 is uncased, so case and whitespace don't change the vector
+        return " ".join(text.lower().split())
+
+    def _disk_key(self, key: str):
+        return hashlib.sha256(f"{self.model_name}\0{key}".encode()).hexdigest()
+
+    def _memory_get(self, key):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return vector
+
+    def _memory_put(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        if self._disk is None:
+            return None
+        with self._disk_lock:
+            row = self._disk.execute("SELECT vector FROM embeddings WHERE key = ?", (self._disk_key(key),)).fetchone()
+        if row is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def _disk_put_many(self, items):
+        if self._disk is None or not items:
+            return
+        rows = [(self._disk_key(key), array("f", vector).tobytes()) for key, vector in items]
+        with self._disk_lock:
+            self._disk.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._disk.commit()
+
+    def _embed_keys(self, keys):
+        # Resolve normalized texts through the disk tier, then the model in one batch
+        vectors = {}
+        misses = []
+        for key in keys:
+            vector = self._disk_get(key)
+            if vector is not None:
+                vectors[key] = vector
+                self.disk_hits += 1
+            else:
+                misses.append(key)
+
+        if misses:
+            self.misses += len(misses)
+            computed = self.model.embed_documents(misses)
+            vectors.update(zip(misses, computed))
+            self._disk_put_many(zip(misses, computed))
+
+        for key, vector in vectors.items():
+            self._memory_put(key, vector)
+        return vectors
+
+    def embed_query(self, text: str):
+        key = self.normalize(text)
+        vector = self._memory_get(key)
+        if vector is None:
+            vector = self._embed_keys([key])[key]
+        return vector
+
+    def embed_documents(self, texts):
+        return self.model.embed_documents(texts)
+
+    async def aembed_query(self, text: str):
+        key = self.normalize(text)
+        vector = self._memory_get(key)
+        if vector is not None:
+            return vector
+
+        # Queue the query; the batch is flushed after the window or when it is full
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    async def aembed_documents(self, texts):
+        return await asyncio.get_running_loop().run_in_executor(None, self.model.embed_documents, texts)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch):
+        keys = list(dict.fromkeys(key for key, _ in batch))
+        self.batches += 1
+        self.batched_queries += len(batch)
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(None, self._embed_keys, keys)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch:
+            if not future.done():
+                future.set_result(vectors[key])
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "batches": self.batches,
+            "avg_batch_size": self.batched_queries / self.batches if self.batches else 0.0,
+        }
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    all-MiniLM-L6-v2 on ONNX Runtime, reproducing the sentence-transformers pipeline
+    (mean pooling over the attention mask, then L2 normalization) without PyTorch.
+
+    The model directory is produced by `export_onnx_model` and holds `model.onnx`,
+    optionally the int8 dynamically-quantized `model.int8.onnx`, and `tokenizer.json`.
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, quantized=False, num_threads=None, batch_size=32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        model_path = os.path.join(model_dir, ONNX_INT8_FILENAME if quantized else ONNX_FILENAME)
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed_batch(self, texts):
+        import numpy as np
+
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_batch(texts[start:start + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text: str):
+        return self._embed_batch([text])[0]
+
+
+def export_onnx_model(output_dir=ONNX_MODEL_DIR, model_name=EMBEDDING_MODEL_NAME, quantize=True):
+    """
+    Exports the Hugging Face model to ONNX (and optionally an int8 copy) for `OnnxEmbeddings`.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    model_path = os.path.join(output_dir, ONNX_FILENAME)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    logging.info(f"Exported {model_name} to {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized_path = os.path.join(output_dir, ONNX_INT8_FILENAME)
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        logging.info(f"Wrote int8 dynamically-quantized model to {quantized_path}")
+
+
+PARITY_SAMPLES = [
+    "How do I cope with stress?",
+    "I can't sleep at night and keep worrying about work.",
+    "What are some grounding techniques for anxiety?",
+    "My friend stopped talking to me and I feel lonely.",
+    "Breathing exercises can help calm the nervous system during a panic attack.",
+]
+
+def parity_check(candidate, reference=None, samples=PARITY_SAMPLES, tolerance=0.99):
+    """
+    Compares a backend's vectors with the reference PyTorch model.
+
+    Existing Qdrant collections stay valid as long as every sample's cosine similarity
+    to the reference vector is at least `tolerance`.
+    
+    Returns:
+        dict: Minimum cosine similarity, maximum absolute difference and pass/fail.
+    """
+    import numpy as np
+
+    if reference is None:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        reference = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+    expected = np.asarray(reference.embed_documents(samples), dtype=np.float32)
+    actual = np.asarray(candidate.embed_documents(samples), dtype=np.float32)
+    cosines = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    return {
+        "min_cosine": float(cosines.min()),
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+        "passed": bool(cosines.min() >= tolerance),
+    }
+
+
+def _create_backend():
+    if EMBEDDING_BACKEND == "onnx":
+        logging.info(f"Loading ONNX embedding model from {ONNX_MODEL_DIR} (int8: {ONNX_QUANTIZED})")
+        return OnnxEmbeddings(
+            ONNX_MODEL_DIR,
+            quantized=ONNX_QUANTIZED,
+            num_threads=int(os.getenv("EMBEDDING_THREADS", "0")) or None,
+            batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+        )
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+    logging.info(f"Loading embedding model: {EMBEDDING_MODEL_NAME}")
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+def _backend_id():
+    # Distinguishes cached vectors produced by different backends
+    if EMBEDDING_BACKEND == "onnx":
+        return f"{EMBEDDING_MODEL_NAME}:onnx{':int8' if ONNX_QUANTIZED else ''}"
+    return EMBEDDING_MODEL_NAME
+
+
+# Shared embedding service: one model (and one query cache) per process, used by
+# both Retriever and Ingestor
+_base_model = None
+_cached_model = None
+_model_lock = threading.Lock()
+
+def get_base_embedding_model():
+    global _base_model
+    with _model_lock:
+        if _base_model is None:
+            _base_model = _create_backend()
+        return _base_model
+
+def get_embedding_model():
+    global _cached_model
+    base_model = get_base_embedding_model()
+    with _model_lock:
+        if _cached_model is None:
+            _cached_model = CachedEmbeddings(
+                base_model,
+                model_name=_backend_id(),
+                max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+                disk_path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+                batch_window_ms=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")),
+                max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32")),
+            )
+        return _cached_model
+
+# Forked workers (see serve.py) keep the preloaded base model, shared copy-on-write,
+# but build their own query cache: it holds a SQLite connection and asyncio state
+def _reset_after_fork():
+    global _cached_model, _model_lock
+    _cached_model = None
+    _model_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the ONNX embedding backend.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export the model to ONNX.")
+    export_parser.add_argument("--output", default=ONNX_MODEL_DIR)
+    export_parser.add_argument("--no-int8", action="store_true", help="Skip the int8 quantized copy.")
+    parity_parser = subparsers.add_parser("parity", help="Compare ONNX vectors with the PyTorch model.")
+    parity_parser.add_argument("--model-dir", default=ONNX_MODEL_DIR)
+    parity_parser.add_argument("--int8", action="store_true", help="Check the int8 quantized model.")
+    parity_parser.add_argument("--tolerance", type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx_model(args.output, quantize=not args.no_int8)
+        return
+
+    result = parity_check(OnnxEmbeddings(args.model_dir, quantized=args.int8), tolerance=args.tolerance)
+    print(json.dumps(result, indent=2))
+    if not result["passed"]:
+        sys.exit(1)
+
+
+# Usage: python embeddings.py export [--no-int8] | python embeddings.py parity [--int8]
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
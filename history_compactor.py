@@ -0,0 +1,118 @@
+import logging
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+from tokens import estimate_message_tokens
+from user import get_chat_records, get_history_state, save_history_summary
+
+
+class HistoryCompactor:
+    """
+    Keeps the chat history sent to the prompts within a token budget.
+
+    The most recent turns are passed verbatim. Older turns are folded into a rolling
+    summary that is stored on the user's 'chat-history' document, together with the
+    sequence number of the last message it covers. Only messages after that point are
+    loaded for a request, so prompt size stays flat as conversations grow.
+
+    The summary is refreshed in the background after a turn, and only once more than
+    `keep_turns + refresh_turns` unsummarized turns have accumulated, so a summarization
+    call is made every `refresh_turns` turns rather than on every message.
+    """
+
+    def __init__(self, llm, keep_turns=4, refresh_turns=4, max_fold_turns=20,
+                 contextualize_token_budget=1000, qa_token_budget=2000):
+        self.llm = llm
+        self.keep_turns = keep_turns
+        self.refresh_turns = refresh_turns
+        self.max_fold_turns = max_fold_turns
+        self.contextualize_token_budget = contextualize_token_budget
+        self.qa_token_budget = qa_token_budget
+
+        summary_template = """Progressively summarize a supportive conversation between a user and a therapy assistant.
+        Keep the facts, feelings and concerns the user shared, and any advice already given.
+        Return only the updated summary.
+
+        Current Summary:
+        {summary}
+
+        New Lines of Conversation:
+        {new_lines}
+
+        Updated Summary:
+        """
+        self.summary_prompt = PromptTemplate(template=summary_template, input_variables=["summary", "new_lines"])
+        self.summary_chain = self.summary_prompt | self.llm | StrOutputParser()
+
+    @property
+    def window_turns(self):
+        # Unsummarized turns that may be loaded for a request before a refresh folds them
+        return self.keep_turns + self.refresh_turns
+
+    def compact(self, chat_history, summary, token_budget):
+        """
+        Builds the history for one prompt: the summary (if any) followed by as many of
+        the newest messages as fit in `token_budget`.
+        
+        Args:
+            chat_history (list): Unsummarized messages, oldest first.
+            summary (str): Rolling summary of everything before `chat_history`.
+            token_budget (int): Maximum estimated tokens for the returned history.
+        
+        Returns:
+            list: Messages to pass as the prompt's chat history.
+        """
+        compacted = []
+        used = 0
+        if summary:
+            summary_message = SystemMessage(content=f"Summary of the earlier conversation: {summary}")
+            used = estimate_message_tokens(summary_message)
+
+        for message in reversed(chat_history):
+            cost = estimate_message_tokens(message)
+            if used + cost > token_budget:
+                break
+            compacted.append(message)
+            used += cost
+        compacted.reverse()
+
+        if summary:
+            compacted.insert(0, summary_message)
+        return compacted
+
+    def contextualize_history(self, chat_history, summary):
+        return self.compact(chat_history, summary, self.contextualize_token_budget)
+
+    def qa_history(self, chat_history, summary):
+        return self.compact(chat_history, summary, self.qa_token_budget)
+
+    async def refresh(self, user_id):
+        """
+        Folds turns older than the verbatim window into the stored summary, if more
+        than `window_turns` unsummarized turns have accumulated. Messages are folded
+        oldest first, at most `max_fold_turns` turns per summarization call, until the
+        unsummarized backlog fits the window again.
+        """
+        limit = (self.window_turns + self.max_fold_turns) * 2
+        while True:
+            state = await get_history_state(user_id)
+            records = await get_chat_records(user_id, after_seq=state["summary_upto"], limit=limit, oldest=True)
+            if len(records) <= self.window_turns * 2:
+                return
+
+            # A full read means more messages follow; fold a whole slice and go on
+            if len(records) == limit:
+                to_fold = records[:self.max_fold_turns * 2]
+            else:
+                to_fold = records[:-self.keep_turns * 2]
+            new_lines = "\n".join(
+                f"{'User' if isinstance(message, HumanMessage) else 'Assistant'}: {message.content}"
+                for _, message in to_fold
+            )
+            summary = await self.summary_chain.ainvoke({"summary": state["summary"] or "(none)", "new_lines": new_lines})
+
+            upto_seq = to_fold[-1][0]
+            if not await save_history_summary(user_id, summary, upto_seq, expected_upto=state["summary_upto"]):
+                # Another refresh got there first and carries on from its own summary
+                return
+            logging.info(f"Folded {len(to_fold)} messages into the history summary for user {user_id}")
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from pymongo import InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+from chat_message import serialize_message
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class HistoryWriter:
+    """
+    Write-behind persistence for chat messages.
+
+    Completed turns are queued in memory and written in the background: messages of
+    the same user are coalesced into one sequence-number reservation, and everything
+    queued is inserted with a single unordered `bulk_write`. A flush runs every
+    `flush_interval` seconds, or sooner once `max_batch_messages` are queued.
+
+    Retries reuse the sequence numbers already reserved, so inserts that made it
+    before a failure show up as duplicate-key errors and are skipped. Messages that
+    still fail after `max_retries` stay queued for the next flush. Until a message
+    is written, `pending_messages` returns it, so this worker reads its own writes.
+
+    Args:
+        get_collection (callable): Returns the async Mongo collection for a name.
+        flush_interval (float): Seconds between background flushes.
+        max_batch_messages (int): Queued messages that trigger an early flush.
+        max_retries (int): Retries per flush on database errors.
+        retry_backoff (float): First retry delay in seconds, doubled per attempt.
+    """
+
+    def __init__(self, get_collection, flush_interval=0.2, max_batch_messages=500, max_retries=5, retry_backoff=0.5):
+        self.get_collection = get_collection
+        self.flush_interval = flush_interval
+        self.max_batch_messages = max_batch_messages
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        # user_id -> serialized messages not yet picked up by a flush
+        self._queued = {}
+        self._queued_count = 0
+        # user_id -> [{"docs": [...], "first_seq": int or None}] being written
+        self._inflight = {}
+
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the background loop and writes everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        remaining = self._queued_count + sum(len(entry["docs"]) for entries in self._inflight.values() for entry in entries)
+        if remaining:
+            logging.error(f"History writer closed with {remaining} unwritten messages")
+
+    def enqueue(self, user_id, messages):
+        if not messages:
+            return
+        self._queued.setdefault(user_id, []).extend(serialize_message(message) for message in messages)
+        self._queued_count += len(messages)
+        if self._queued_count >= self.max_batch_messages:
+            self._wakeup.set()
+
+    def pending_messages(self, user_id):
+        """
+        Returns the user's unwritten messages, oldest first, as (seq, serialized message)
+        pairs; seq is None until its number is reserved.
+        """
+        pending = []
+        for entry in self._inflight.get(user_id, []):
+            first_seq = entry["first_seq"]
+            pending.extend((None if first_seq is None else first_seq + i, doc) for i, doc in enumerate(entry["docs"]))
+        pending.extend((None, doc) for doc in self._queued.get(user_id, []))
+        return pending
+
+    def pending_count(self, user_id):
+        inflight = sum(len(entry["docs"]) for entry in self._inflight.get(user_id, []))
+        return inflight + len(self._queued.get(user_id, []))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._take_queued()
+            if not self._inflight:
+                return
+
+            for attempt in range(self.max_retries + 1):
+                try:
+                    started = time.perf_counter()
+                    written = await self._write()
+                    self.flushes += 1
+                    self.written += written
+                    logging.debug(f"Flushed {written} chat messages in {(time.perf_counter() - started) * 1000:.0f}ms")
+                    return
+                except PyMongoError as e:
+                    self.failures += 1
+                    if attempt == self.max_retries:
+                        logging.error(f"Chat history flush failed, keeping messages queued: {e}")
+                        return
+                    delay = self.retry_backoff * 2 ** attempt
+                    logging.warning(f"Chat history flush failed, retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+
+    def _take_queued(self):
+        # Queued messages join the user's last in-flight entry while it has no seq range
+        # yet, so each user needs at most one new reservation per flush
+        for user_id, docs in self._queued.items():
+            entries = self._inflight.setdefault(user_id, [])
+            if entries and entries[-1]["first_seq"] is None:
+                entries[-1]["docs"].extend(docs)
+            else:
+                entries.append({"docs": docs, "first_seq": None})
+        self._queued = {}
+        self._queued_count = 0
+
+    async def _reserve(self, user_id, entry):
+        counter = await self.get_collection("chat-history").find_one_and_update(
+            {"user_id": user_id},
+            {"$inc": {"seq": len(entry["docs"])}},
+            projection={"seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        entry["first_seq"] = counter["seq"] - len(entry["docs"]) + 1
+
+    async def _write(self):
+        await asyncio.gather(*[
+            self._reserve(user_id, entries[-1])
+            for user_id, entries in self._inflight.items()
+            if entries[-1]["first_seq"] is None
+        ])
+
+        requests = [
+            InsertOne({"user_id": user_id, "seq": entry["first_seq"] + i, **doc})
+            for user_id, entries in self._inflight.items()
+            for entry in entries
+            for i, doc in enumerate(entry["docs"])
+        ]
+        try:
+            await self.get_collection("chat-messages").bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates were written by an earlier attempt of this flush
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors) or e.details.get("writeConcernErrors"):
+                raise
+        self._inflight = {}
+        return len(requests)
+
+    def stats(self):
+        return {
+            "queued": self._queued_count,
+            "inflight": sum(len(entry["docs"]) for entries in self._inflight.values() for entry in entries),
+            "flushes": self.flushes,
+            "written": self.written,
+            "failures": self.failures,
+        }
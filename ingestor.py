@@ -1,12 +1,28 @@
 import os
+import argparse
+import hashlib
+import json
 import logging
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_huggingface import HuggingFaceEmbeddings
+from embeddings import get_base_embedding_model
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Distance, VectorParams
+from qdrant_client.models import (
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    HasIdCondition,
+    MatchValue,
+    PointStruct,
+    SetPayload,
+    SetPayloadOperation,
+)
 from dotenv import load_dotenv
 from langchain.text_splitter import RecursiveCharacterTextSplitter  # Import the text splitter
+from retriever import CONTENT_PAYLOAD_KEY
+from qdrant_profiles import apply_profile, create_collection, ensure_payload_indexes, get_profile
 
 # Load environment variables
 load_dotenv()
@@ -14,80 +30,315 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+
+# Namespace for deterministic point IDs, so re-ingesting a chunk overwrites its point
+POINT_ID_NAMESPACE = uuid.UUID("6f1c2d4e-8b3a-5c7d-9e0f-1a2b3c4d5e6f")
+MANIFEST_FILENAME = ".ingest-manifest.json"
+
+
+def point_id(source, page, chunk):
+    content_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{source}\0{page}\0{content_hash}"))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_and_split(pdf_path, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """
+    Loads a PDF and splits each page into chunks. Runs in a worker process.
+    
+    Args:
+        pdf_path (str): Path to the PDF file.
+        chunk_size (int): Maximum characters per chunk.
+        chunk_overlap (int): Characters shared by adjacent chunks.
+    
+    Returns:
+        list: (page index, chunk index, chunk text) tuples in document order.
+    """
+    documents = PyMuPDFLoader(pdf_path).load()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    for idx, doc in enumerate(documents):
+        for chunk_idx, chunk in enumerate(text_splitter.split_text(doc.page_content)):
+            chunks.append((idx, chunk_idx, chunk))
+    return chunks
+
+
 class Ingestor:
-    def __init__(self, folder_path):
+    """
+    Incrementally ingests the PDFs in a folder into Qdrant.
+
+    Point IDs are derived from the source file, page and chunk content, and a manifest
+    of file hashes, tied to the target collection, is kept next to the PDFs. Unchanged
+    files are skipped, points of removed files are deleted, and for changed files only
+    chunks whose content is new are embedded before stale points are dropped.
+    """
+
+    def __init__(self, folder_path, embed_batch_size=64, upsert_batch_size=256, parallel_uploads=1, max_workers=None, manifest_path=None,
+                 qdrant_client=None, embedding_model=None, profile=None):
         self.folder_path = folder_path
+        self.manifest_path = manifest_path or os.path.join(folder_path, MANIFEST_FILENAME)
         self.collection_name = os.getenv("QDRANT_COLLECTION_NAME")
-        self.qdrant_client = QdrantClient(url=os.getenv("QDRANT_URL"),
+        self.qdrant_url = os.getenv("QDRANT_URL")
+        self.qdrant_client = qdrant_client or QdrantClient(url=self.qdrant_url,
             api_key=os.getenv("QDRANT_API_KEY"))
-        self.embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)  # Set chunk size and overlap
+        self.embedding_model = embedding_model or get_base_embedding_model()
+
+        # Vector storage, HNSW and quantization settings (see qdrant_profiles.py)
+        self.profile_name = profile or os.getenv("QDRANT_COLLECTION_PROFILE", "default")
+        self.profile = get_profile(self.profile_name)
+
+        # Batching and parallelism settings
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.parallel_uploads = parallel_uploads
+        self.max_workers = max_workers
+
         self._setup_collection()
 
     def _setup_collection(self):
         # Create or access collection
-        try:
-            self.qdrant_client.get_collection(self.collection_name)
+        if self.qdrant_client.collection_exists(self.collection_name):
+            # Collections created before payload indexes existed get them here
+            ensure_payload_indexes(self.qdrant_client, self.collection_name)
             logging.info(f"Using existing collection: {self.collection_name}")
-        except:
-            self.qdrant_client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=VectorParams(size=384, distance=Distance.COSINE)
-            )
-            logging.info(f"Created new collection: {self.collection_name}")
+        else:
+            create_collection(self.qdrant_client, self.collection_name, self.profile)
+            logging.info(f"Created new collection: {self.collection_name} (profile: {self.profile_name})")
+
+    def apply_profile(self):
+        # Re-tune an existing collection in place, without re-ingesting
+        apply_profile(self.qdrant_client, self.collection_name, self.profile)
+        logging.info(f"Applied profile {self.profile_name} to {self.collection_name}")
+
+    def rebuild_collection(self):
+        # Drop everything, including points written before IDs were deterministic
+        self.qdrant_client.delete_collection(self.collection_name)
+        self._setup_collection()
+        self._save_manifest({})
+
+    def _manifest_target(self):
+        # The collection the manifest's file hashes were ingested into
+        return {"collection": self.collection_name, "url": self.qdrant_url}
 
-    def ingest_all_pdfs(self):
+    def _load_manifest(self):
+        """
+        Returns the manifest's {filename: entry} map. If it was written for another
+        collection or server (or predates that being recorded), or the collection is
+        empty, the file hashes are dropped so every file is checked again; the entries
+        are kept so points of removed files are still deleted.
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            data = json.load(f)
+        files = data["files"] if "files" in data else data
+
+        if data.get("target") != self._manifest_target():
+            logging.warning(f"Manifest {self.manifest_path} was not written for {self.collection_name} at this Qdrant; re-checking every file")
+        elif files and self.qdrant_client.count(collection_name=self.collection_name, exact=True).count == 0:
+            logging.warning(f"Collection {self.collection_name} is empty; re-checking every file")
+        else:
+            return files
+        return {filename: {key: value for key, value in entry.items() if key != "sha256"} for filename, entry in files.items()}
+
+    def _save_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"target": self._manifest_target(), "files": manifest}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _source_filter(self, source, keep_ids=None):
+        must_not = [HasIdCondition(has_id=list(keep_ids))] if keep_ids else None
+        return Filter(
+            must=[FieldCondition(key="source", match=MatchValue(value=source))],
+            must_not=must_not,
+        )
+
+    def _delete_source(self, source, keep_ids=None):
+        self.qdrant_client.delete(
+            collection_name=self.collection_name,
+            points_selector=FilterSelector(filter=self._source_filter(source, keep_ids)),
+            wait=True,
+        )
+
+    def ingest_all_pdfs(self, dry_run=False):
         if not os.path.exists(self.folder_path):
           logging.error(f"PDF folder '{self.folder_path}' does not exist.")
           return
-        # Traverse the folder and process all PDFs
-        pdf_files = [f for f in os.listdir(self.folder_path) if f.endswith(".pdf")]
+        # Traverse the folder and work out what changed since the last run
+        pdf_files = sorted(f for f in os.listdir(self.folder_path) if f.endswith(".pdf"))
         logging.info(f"Found {len(pdf_files)} PDF files in folder: {self.folder_path}")
-        
-        for filename in pdf_files:
-            file_path = os.path.join(self.folder_path, filename)
-            logging.info(f"Starting ingestion for file: {filename}")
-            self._process_pdf(file_path)
-            logging.info(f"Finished ingestion for file: {filename}")
-
-    def _process_pdf(self, pdf_path):
-        try:
-            # Load PDF and split into chunks
-            loader = PyMuPDFLoader(pdf_path)
-            documents = loader.load()
-            logging.info(f"Loaded {len(documents)} pages from {pdf_path}")
-
-            # Process each page
-            for idx, doc in enumerate(documents):
-                content = doc.page_content
-
-                # Split content into chunks using the text splitter
-                chunks = self.text_splitter.split_text(content)
-                logging.info(f"Split page {idx} into {len(chunks)} chunks")
-
-                # Embed and store each chunk
-                for chunk_idx, chunk in enumerate(chunks):
-                    embedding = self.embedding_model.embed_query(chunk)
-
-                    # Create a unique point ID for each document chunk
-                    point_id = str(uuid.uuid4())
-                    point = PointStruct(
-                        id=point_id,
-                        vector=embedding,
-                        payload={"source": pdf_path, "page": idx, "chunk": chunk_idx}
-                    )
-
-                    # Insert embedding into Qdrant
-                    self.qdrant_client.upsert(collection_name=self.collection_name, points=[point])
-                    logging.info(f"Stored embedding for chunk {chunk_idx} of page {idx} in Qdrant")
-
-            logging.info(f"Ingestion completed for {pdf_path}")
-
-        except Exception as e:
-            logging.error(f"Error processing {pdf_path}: {e}")
-
-# Usage
-current_dir = os.path.dirname(os.path.abspath(__file__))
-folder_path = os.path.join(current_dir, "data")
-ingestor = Ingestor(folder_path)
-ingestor.ingest_all_pdfs()
+
+        manifest = self._load_manifest()
+        hashes = {filename: file_hash(os.path.join(self.folder_path, filename)) for filename in pdf_files}
+        changed = [f for f in pdf_files if manifest.get(f, {}).get("sha256") != hashes[f]]
+        removed = [f for f in manifest if f not in hashes]
+        logging.info(f"{len(changed)} new or changed, {len(pdf_files) - len(changed)} unchanged, {len(removed)} removed")
+        if dry_run:
+            for filename in changed:
+                logging.info(f"Would ingest: {filename}")
+            for filename in removed:
+                logging.info(f"Would delete points for: {filename}")
+            return
+
+        for filename in removed:
+            self._delete_source(manifest[filename]["source"])
+            del manifest[filename]
+            self._save_manifest(manifest)
+            logging.info(f"Deleted points for removed file: {filename}")
+
+        started = time.perf_counter()
+        total_chunks = 0
+
+        # PDFs are parsed and split in worker processes while this process embeds and uploads
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {
+                pool.submit(load_and_split, os.path.join(self.folder_path, filename)): filename
+                for filename in changed
+            }
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing {filename}: {e}")
+                    continue
+
+                logging.info(f"Starting ingestion for file: {filename} ({len(chunks)} chunks)")
+                total_chunks += self._ingest_chunks(filename, chunks)
+                manifest[filename] = {"sha256": hashes[filename], "source": filename, "chunks": len(chunks)}
+                self._save_manifest(manifest)
+                elapsed = time.perf_counter() - started
+                logging.info(f"Finished ingestion for file: {filename} - {total_chunks} chunks in {elapsed:.1f}s ({total_chunks / elapsed:.1f} chunks/sec overall)")
+
+        elapsed = time.perf_counter() - started
+        logging.info(f"Ingested {total_chunks} chunks from {len(changed)} files in {elapsed:.1f}s ({total_chunks / elapsed if elapsed else 0:.1f} chunks/sec)")
+
+    def _existing_chunks(self, ids):
+        # Stored chunk index of each existing point
+        existing = {}
+        for start in range(0, len(ids), self.upsert_batch_size):
+            records = self.qdrant_client.retrieve(
+                collection_name=self.collection_name,
+                ids=ids[start:start + self.upsert_batch_size],
+                with_payload=["chunk"],
+                with_vectors=False,
+            )
+            existing.update((str(record.id), (record.payload or {}).get("chunk")) for record in records)
+        return existing
+
+    def _update_chunk_indexes(self, chunk_indexes):
+        # Point IDs don't include the chunk index, so an unchanged chunk that moved keeps
+        # its point; its index must still be right for merging adjacent chunks at query time
+        operations = [
+            SetPayloadOperation(set_payload=SetPayload(payload={"chunk": chunk_idx}, points=[point]))
+            for point, chunk_idx in chunk_indexes.items()
+        ]
+        for start in range(0, len(operations), self.upsert_batch_size):
+            self.qdrant_client.batch_update_points(
+                collection_name=self.collection_name,
+                update_operations=operations[start:start + self.upsert_batch_size],
+                wait=True,
+            )
+
+    def _ingest_chunks(self, source, chunks):
+        started = time.perf_counter()
+
+        # Only chunks whose content isn't already stored need embedding
+        ids = [point_id(source, idx, chunk) for idx, _, chunk in chunks]
+        existing = self._existing_chunks(list(dict.fromkeys(ids)))
+        pending = [(point, chunk) for point, chunk in zip(ids, chunks) if point not in existing]
+        logging.info(f"{source}: {len(chunks) - len(pending)} chunks unchanged, {len(pending)} to embed")
+
+        # A chunk repeated on one page has a single point, indexed by its first occurrence
+        moved = {}
+        for point, (_, chunk_idx, _) in zip(ids, chunks):
+            if point in existing:
+                moved.setdefault(point, chunk_idx)
+        moved = {point: chunk_idx for point, chunk_idx in moved.items() if existing[point] != chunk_idx}
+        if moved:
+            self._update_chunk_indexes(moved)
+            logging.info(f"{source}: updated the chunk index of {len(moved)} moved chunks")
+
+        points = []
+        for start in range(0, len(pending), self.embed_batch_size):
+            batch = pending[start:start + self.embed_batch_size]
+
+            # Embed the whole batch in one forward pass
+            embeddings = self.embedding_model.embed_documents([chunk for _, (_, _, chunk) in batch])
+            for (point, (idx, chunk_idx, chunk)), embedding in zip(batch, embeddings):
+                points.append(PointStruct(
+                    id=point,
+                    vector=embedding,
+                    payload={CONTENT_PAYLOAD_KEY: chunk, "source": source, "page": idx, "chunk": chunk_idx}
+                ))
+
+            if len(points) >= self.upsert_batch_size:
+                self._upload(points)
+                points = []
+        self._upload(points)
+
+        # Drop points of chunks that no longer exist in this file
+        self._delete_source(source, keep_ids=set(ids))
+
+        elapsed = time.perf_counter() - started
+        logging.info(f"Ingestion completed for {source}: {len(pending)} chunks embedded in {elapsed:.1f}s ({len(pending) / elapsed if elapsed else 0:.1f} chunks/sec)")
+        return len(pending)
+
+    def _upload(self, points):
+        if not points:
+            return
+        # Bulk upsert into Qdrant, optionally across several upload workers
+        self.qdrant_client.upload_points(
+            collection_name=self.collection_name,
+            points=points,
+            batch_size=self.upsert_batch_size,
+            parallel=self.parallel_uploads,
+            wait=True,
+        )
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Incrementally ingest PDFs into the Qdrant collection.")
+    parser.add_argument("folder", nargs="?", default=os.path.join(current_dir, "data"), help="Folder containing the PDFs.")
+    parser.add_argument("--manifest", help="Manifest path (defaults to <folder>/.ingest-manifest.json).")
+    parser.add_argument("--rebuild", action="store_true", help="Recreate the collection and re-ingest everything.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which files would be ingested or deleted.")
+    parser.add_argument("--embed-batch-size", type=int, default=int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64")))
+    parser.add_argument("--upsert-batch-size", type=int, default=int(os.getenv("INGEST_UPSERT_BATCH_SIZE", "256")))
+    parser.add_argument("--parallel-uploads", type=int, default=int(os.getenv("INGEST_PARALLEL_UPLOADS", "1")))
+    parser.add_argument("--workers", type=int, default=None, help="PDF parsing processes (defaults to CPU count).")
+    parser.add_argument("--profile", help="Collection profile from qdrant_profiles.py (defaults to QDRANT_COLLECTION_PROFILE).")
+    parser.add_argument("--apply-profile", action="store_true", help="Apply the profile to the existing collection and exit.")
+    args = parser.parse_args()
+
+    ingestor = Ingestor(
+        args.folder,
+        embed_batch_size=args.embed_batch_size,
+        upsert_batch_size=args.upsert_batch_size,
+        parallel_uploads=args.parallel_uploads,
+        max_workers=args.workers,
+        manifest_path=args.manifest,
+        profile=args.profile,
+    )
+    if args.apply_profile:
+        ingestor.apply_profile()
+        return
+    if args.rebuild and not args.dry_run:
+        ingestor.rebuild_collection()
+    ingestor.ingest_all_pdfs(dry_run=args.dry_run)
+
+
+# Usage: python ingestor.py [folder] [--rebuild] [--dry-run]
+if __name__ == "__main__":
+    main()
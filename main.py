@@ -1,13 +1,147 @@
+import time
+
+_import_started = time.perf_counter()
+
+import os
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request, Depends
-from auth import get_current_user  # Import the JWT verification function
-from conversation import Conversation
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from auth import get_current_user, token_cache  # Import the JWT verification function
+from concurrency import AdmissionController, KeyedLocks, Overloaded
 from models import UserInfo
 from langchain_core.messages import HumanMessage, SystemMessage
-from user import get_chat_history, get_user, save_chat_history, sign_up_user, login_user, choose_character  # Import user operations
+from mongodb import AsyncMongoDB
+from telemetry import ServerTimingMiddleware, current_metrics, metrics_response_body
+from user import USER_PROFILE_WATCH, ensure_indexes, get_chat_history, get_history_state, get_user, history_writer, profile_cache, save_chat_turn, sign_up_user, login_user, choose_character, watch_user_profiles  # Import user operations
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Heavy dependencies (embedding model, LangChain chains, Qdrant) are loaded in the
+# background after the server starts; keep module import time low so the port binds
+# quickly. Inspect with: python -X importtime -c "import main"
+STARTUP_RETRY_INTERVAL = float(os.getenv("STARTUP_RETRY_INTERVAL", "5"))
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
+
+# Turns of the same user run one at a time, so concurrent requests can't lose a turn
+user_turn_locks = KeyedLocks()
+
+# Global cap on concurrent LLM calls, with a bounded wait queue
+llm_admission = AdmissionController(
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", "64")),
+    max_wait=float(os.getenv("LLM_MAX_WAIT", "10")),
+    retry_after=int(os.getenv("LLM_RETRY_AFTER", "2")),
+)
+
+
+def build_conversation():
+    # Imported here so that loading LangChain/PyTorch doesn't count against import time
+    from conversation import Conversation
+    return Conversation()
+
+async def initialize(app: FastAPI):
+    """
+    Builds the Conversation and warms it up, retrying until dependencies are available.
+    Failures keep the process alive and /readyz reports them instead.
+    """
+    while True:
+        started = time.perf_counter()
+        try:
+            await ensure_indexes()
+            conversation = await run_in_threadpool(build_conversation)
+            await conversation.warmup()
+            app.state.conversation = conversation
+            app.state.startup_error = None
+            logging.info(f"Conversation ready in {time.perf_counter() - started:.2f}s")
+            return
+        except Exception as e:
+            app.state.startup_error = str(e)
+            logging.exception(f"Initialization failed, retrying in {STARTUP_RETRY_INTERVAL}s")
+            await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.conversation = None
+    app.state.startup_error = None
+    background_tasks = [asyncio.create_task(initialize(app))]
+    if USER_PROFILE_WATCH:
+        background_tasks.append(asyncio.create_task(watch_user_profiles()))
+    history_writer.start()
+    yield
+    for task in background_tasks:
+        task.cancel()
+    # Write out chat turns still queued before the process exits
+    await history_writer.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-conversation = Conversation()
+# Per-stage timings: Server-Timing header, Prometheus histograms and sampled request logs
+app.add_middleware(ServerTimingMiddleware)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        {"detail": "Server is busy, please retry"},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# Dependency returning the Conversation, or 503 while it is still initializing
+def get_conversation(request: Request):
+    conversation = request.app.state.conversation
+    if conversation is None:
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
+    return conversation
+
+# Liveness: the process is up and serving requests
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: the Conversation is loaded and MongoDB answers
+@app.get("/readyz")
+async def readyz(request: Request):
+    checks = {"conversation": request.app.state.conversation is not None}
+    try:
+        await asyncio.wait_for(AsyncMongoDB().ping(), READINESS_TIMEOUT)
+        checks["mongodb"] = True
+    except Exception:
+        checks["mongodb"] = False
+
+    ready = all(checks.values())
+    body = {"status": "ready" if ready else "not ready", "checks": checks}
+    if request.app.state.startup_error:
+        body["startup_error"] = request.app.state.startup_error
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+# Internal counters: LLM admission queue, per-user locks and caches
+@app.get("/stats")
+async def stats(request: Request):
+    body = {
+        "llm_admission": llm_admission.stats(),
+        "user_turn_locks": len(user_turn_locks),
+        "token_cache": token_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "history_writer": history_writer.stats(),
+    }
+    conversation = request.app.state.conversation
+    if conversation is not None:
+        if hasattr(conversation.retriever.embedding_model, "stats"):
+            body["embedding_cache"] = conversation.retriever.embedding_model.stats()
+        if conversation.answer_cache is not None:
+            body["answer_cache"] = conversation.answer_cache.stats()
+    return body
+
+# Prometheus metrics: per-stage latency, token and retrieved-document histograms
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_response_body()
+    return Response(body, media_type=content_type)
 
 # Endpoint for user sign up
 @app.post("/api/signup")
@@ -19,8 +153,8 @@ async def sign_up(request: Request):
     if not email or not password:
         raise HTTPException(status_code=400, detail="Email and password required")
 
-    # Sign up the user and store information in MongoDB
-    return sign_up_user(email, password)
+    # Sign up the user and store information in MongoDB (blocking Auth0 calls run off the event loop)
+    return await run_in_threadpool(sign_up_user, email, password)
 
 
 # Endpoint for user login
@@ -34,7 +168,7 @@ async def login(request: Request):
         raise HTTPException(status_code=400, detail="Email and password required")
 
     # Log in the user and return JWT token
-    return login_user(email, password)
+    return await run_in_threadpool(login_user, email, password)
 
 
 # Endpoint for character selection (protected route)
@@ -44,14 +178,14 @@ async def select_character(request: Request, user: dict = Depends(get_current_us
     selected_character = body.get("character")
 
     # Call the function to store the selected character in MongoDB
-    return choose_character(user["sub"], selected_character)
+    return await choose_character(user["sub"], selected_character)
 
 @app.get("/api/user-info", response_model=UserInfo)
 async def get_user_info(user: dict = Depends(get_current_user)):
     auth0_id = user["sub"]  # Auth0's unique identifier for the user
 
     # Fetch user data from MongoDB based on Auth0 ID
-    user_data = get_user(auth0_id)
+    user_data = await get_user(auth0_id)
 
     if not user_data:
         raise HTTPException(status_code=404, detail="User not found")
@@ -61,13 +195,33 @@ async def get_user_info(user: dict = Depends(get_current_user)):
         selected_character=user_data.get("selected_character", "girl"),
     )
     
+# Load the rolling summary and the messages it doesn't cover yet
+async def load_chat_history(conversation, user_id: str):
+    history_state = await get_history_state(user_id)
+    chat_history = await get_chat_history(
+        user_id,
+        turns=conversation.compactor.window_turns,
+        after_seq=history_state["summary_upto"],
+    )
+    return history_state, chat_history
+
+# Messages to append for a completed turn, greeting first on a new conversation
+def turn_messages(chat_history, user_message, assistant_response):
+    messages = []
+    if not chat_history:
+        messages.append(SystemMessage(content="Hello! How can I help you today?"))
+    messages.append(HumanMessage(content=user_message))
+    messages.append(SystemMessage(content=assistant_response))
+    return messages
+
+# Format a Server-Sent Event with a JSON payload
+def sse_event(event: str, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.post("/api/chat")
-async def chat(request: Request, user: dict = Depends(get_current_user)):
+async def chat(request: Request, user: dict = Depends(get_current_user), conversation=Depends(get_conversation)):
     # Get the user ID from the JWT token
     user_id = user["sub"]
-    
-    # fetch chat history from MongoDB based on user ID
-    chat_history = get_chat_history(user_id)
 
     # Get the user's message from the request
     body = await request.json()
@@ -75,17 +229,75 @@ async def chat(request: Request, user: dict = Depends(get_current_user)):
     if not user_message:
         raise HTTPException(status_code=400, detail="Message content is required")
 
-    # Use the Conversation class to generate a response
-    assistant_response = conversation.handle_message(user_message, chat_history)
+    async with user_turn_locks.hold(user_id):
+        # fetch the not-yet-summarized chat history from MongoDB based on user ID
+        history_state, chat_history = await load_chat_history(conversation, user_id)
 
-    #Update the chat history with the new message and assistant response
-    if not chat_history or not isinstance(chat_history[0], SystemMessage):
-        chat_history.insert(0,SystemMessage(content="Hello! How can I help you today?"))  # Insert at the beginning if not present
-    chat_history.append(HumanMessage(content=user_message))
-    chat_history.append(SystemMessage(content=assistant_response))
+        # Use the Conversation class to generate a response
+        async with llm_admission.slot():
+            assistant_response = await conversation.ahandle_message(user_message, chat_history, history_state["summary"], user_id=user_id)
 
-    # Save the updated chat history back to MongoDB
-    save_chat_history(user_id, chat_history)
+        # Queue only the new messages for the chat history in MongoDB (written in the background)
+        await save_chat_turn(user_id, turn_messages(chat_history, user_message, assistant_response))
+    conversation.schedule_history_refresh(user_id)
+    conversation.remember_turn(user_id, user_message, assistant_response)
 
     # Return the assistant's response
-    return {"response": assistant_response}
\ No newline at end of file
+    return {"response": assistant_response}
+
+# Streaming variant of /api/chat: sources first, then answer tokens as Server-Sent Events
+@app.post("/api/chat/stream")
+async def chat_stream(request: Request, user: dict = Depends(get_current_user), conversation=Depends(get_conversation)):
+    user_id = user["sub"]
+
+    body = await request.json()
+    user_message = body.get("message")
+    if not user_message:
+        raise HTTPException(status_code=400, detail="Message content is required")
+
+    # Reject up front when saturated; the slot itself is taken inside the stream so
+    # it is always released, even if the client goes away before streaming starts
+    llm_admission.check()
+
+    async def event_stream():
+        answer_parts = []
+        try:
+            async with user_turn_locks.hold(user_id):
+                history_state, chat_history = await load_chat_history(conversation, user_id)
+                async with llm_admission.slot():
+                    async for event, data in conversation.astream_message(user_message, chat_history, history_state["summary"], user_id=user_id):
+                        if event == "token":
+                            answer_parts.append(data)
+                        yield sse_event(event, data)
+
+                # Save the history only once the full answer has been generated
+                assistant_response = "".join(answer_parts)
+                await save_chat_turn(user_id, turn_messages(chat_history, user_message, assistant_response))
+        except Overloaded as e:
+            yield sse_event("error", {"detail": "Server is busy, please retry", "retry_after": e.retry_after})
+            return
+        except asyncio.CancelledError:
+            # Starlette cancels the response when the client disconnects, which aborts
+            # the upstream LLM request; the unfinished turn is not saved
+            logging.info(f"Client disconnected, stopped streaming for user {user_id}")
+            raise
+        except Exception as e:
+            # The 200 status already went out; a terminal event tells the client this
+            # was a failure, not a dropped connection
+            logging.exception(f"Streaming chat failed for user {user_id}: {e}")
+            yield sse_event("error", {"detail": "Failed to generate a response"})
+            return
+        conversation.schedule_history_refresh(user_id)
+        conversation.remember_turn(user_id, user_message, assistant_response)
+
+        # The Server-Timing header went out before generation, so the full timings ride on the last event
+        yield sse_event("done", {"response": assistant_response, "metrics": current_metrics().as_dict()})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+logging.info(f"Imported main in {(time.perf_counter() - _import_started) * 1000:.0f}ms")
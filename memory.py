@@ -0,0 +1,146 @@
+import os
+import time
+import uuid
+import logging
+from dotenv import load_dotenv
+from langchain_core.messages import SystemMessage
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    HnswConfigDiff,
+    KeywordIndexParams,
+    MatchValue,
+    PointStruct,
+    VectorParams,
+)
+from embeddings import get_embedding_model
+from telemetry import stage
+from tokens import estimate_tokens
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+VECTOR_SIZE = 384
+MEMORY_ID_NAMESPACE = uuid.UUID("3b7e9a1c-5d2f-4e6a-8c0b-9f1e2d3c4b5a")
+
+
+class ConversationMemory:
+    """
+    Long-term, per-user memory of past exchanges in a Qdrant collection.
+
+    Each completed turn is embedded as one "user question + assistant answer" point,
+    tagged with the user's ID. All users share the collection; the `user_id` payload
+    index is marked as the tenant key and the HNSW graph is built per user, so a
+    recall only walks that user's points.
+
+    Args:
+        qdrant_client (QdrantClient): Sync client, used to create the collection.
+        async_qdrant_client (AsyncQdrantClient): Client for writes and recalls.
+        embedding_model: Embeddings used for both the exchanges and the queries.
+        collection_name (str): Memory collection.
+        top_k (int): Past exchanges recalled per turn.
+        score_threshold (float): Minimum similarity for a recalled exchange.
+        token_budget (int): Maximum estimated tokens of recalled text per turn.
+    """
+
+    def __init__(self, qdrant_client=None, async_qdrant_client=None, embedding_model=None, collection_name=None,
+                 top_k=3, score_threshold=0.5, token_budget=600):
+        self.collection_name = collection_name or os.getenv("MEMORY_COLLECTION_NAME", "chat_memory")
+        self.qdrant_client = qdrant_client or QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+        self.async_qdrant_client = async_qdrant_client or AsyncQdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+        self.embedding_model = embedding_model or get_embedding_model()
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+        self.token_budget = token_budget
+
+        self._setup_collection()
+
+    def _setup_collection(self):
+        if self.qdrant_client.collection_exists(self.collection_name):
+            return
+        self.qdrant_client.create_collection(
+            collection_name=self.collection_name,
+            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+            # No global graph: one per user_id, which is all a recall ever searches
+            hnsw_config=HnswConfigDiff(m=0, payload_m=16),
+        )
+        self.qdrant_client.create_payload_index(
+            collection_name=self.collection_name,
+            field_name="user_id",
+            field_schema=KeywordIndexParams(type="keyword", is_tenant=True),
+        )
+        logging.info(f"Created memory collection: {self.collection_name}")
+
+    @staticmethod
+    def _exchange_text(user_message, assistant_response):
+        return f"User: {user_message}\nAssistant: {assistant_response}"
+
+    async def remember(self, user_id, user_message, assistant_response):
+        """Embeds one completed exchange and stores it in the user's memory."""
+        created_at = time.time()
+        text = self._exchange_text(user_message, assistant_response)
+        [vector] = await self.embedding_model.aembed_documents([text])
+        await self.async_qdrant_client.upsert(
+            collection_name=self.collection_name,
+            points=[PointStruct(
+                id=str(uuid.uuid5(MEMORY_ID_NAMESPACE, f"{user_id}\0{created_at}\0{user_message}")),
+                vector=vector,
+                payload={
+                    "user_id": user_id,
+                    "user_message": user_message,
+                    "assistant_response": assistant_response,
+                    "created_at": created_at,
+                },
+            )],
+            wait=False,
+        )
+
+    async def recall(self, user_id, query, exclude_messages=()):
+        """
+        Returns the user's past exchanges most similar to `query`, best first, within
+        the token budget. Exchanges whose user message is in `exclude_messages` (the
+        turns already in the prompt) are skipped.
+        """
+        with stage("memory_recall"):
+            vector = await self.embedding_model.aembed_query(query)
+            response = await self.async_qdrant_client.query_points(
+                collection_name=self.collection_name,
+                query=vector,
+                query_filter=Filter(must=[FieldCondition(key="user_id", match=MatchValue(value=user_id))]),
+                limit=self.top_k + len(exclude_messages),
+                score_threshold=self.score_threshold,
+                with_payload=True,
+            )
+
+        excluded = set(exclude_messages)
+        exchanges, used = [], 0
+        for point in response.points:
+            payload = point.payload or {}
+            if payload.get("user_message") in excluded:
+                continue
+            text = self._exchange_text(payload.get("user_message", ""), payload.get("assistant_response", ""))
+            cost = estimate_tokens(text)
+            if used + cost > self.token_budget:
+                break
+            exchanges.append(payload)
+            used += cost
+            if len(exchanges) == self.top_k:
+                break
+        return exchanges
+
+    @staticmethod
+    def to_message(exchanges):
+        """Formats recalled exchanges, oldest first, as one system message for the prompt."""
+        if not exchanges:
+            return None
+        lines = [
+            ConversationMemory._exchange_text(exchange.get("user_message", ""), exchange.get("assistant_response", ""))
+            for exchange in sorted(exchanges, key=lambda exchange: exchange.get("created_at", 0))
+        ]
+        return SystemMessage(content="Relevant moments from earlier conversations:\n" + "\n\n".join(lines))
+
@@ -0,0 +1,53 @@
+import argparse
+import logging
+from pymongo import UpdateOne
+from mongodb import MongoDB
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Converts legacy 'chat-history' documents, which keep the whole conversation in a
+# 'chat_history' array, into one 'chat-messages' document per message.
+#
+# Legacy messages get sequence numbers -n..-1, so they sort before anything a user
+# already wrote through the new storage (which starts at 1). Each message is upserted
+# on (user_id, seq), so an interrupted run can simply be restarted.
+def migrate(batch_size=1000, dry_run=False):
+    mongo_instance = MongoDB()
+    chat_history_collection = mongo_instance.get_collection("chat-history")
+    chat_messages_collection = mongo_instance.get_collection("chat-messages")
+
+    migrated_users = 0
+    migrated_messages = 0
+    for record in chat_history_collection.find({"chat_history": {"$exists": True}}):
+        user_id = record["user_id"]
+        serialized_history = record.get("chat_history") or []
+        offset = len(serialized_history)
+
+        operations = [
+            UpdateOne(
+                {"user_id": user_id, "seq": i - offset},
+                {"$setOnInsert": {"user_id": user_id, "seq": i - offset, **msg}},
+                upsert=True,
+            )
+            for i, msg in enumerate(serialized_history)
+        ]
+        logging.info(f"Migrating {len(operations)} messages for user {user_id}")
+
+        if not dry_run:
+            for start in range(0, len(operations), batch_size):
+                chat_messages_collection.bulk_write(operations[start:start + batch_size], ordered=False)
+            chat_history_collection.update_one({"_id": record["_id"]}, {"$unset": {"chat_history": ""}})
+
+        migrated_users += 1
+        migrated_messages += len(operations)
+
+    logging.info(f"Migrated {migrated_messages} messages for {migrated_users} users")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate chat history arrays to per-message documents.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Messages per bulk write.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be migrated.")
+    args = parser.parse_args()
+    migrate(batch_size=args.batch_size, dry_run=args.dry_run)
@@ -1,4 +1,4 @@
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient
 import os
 from dotenv import load_dotenv
 
@@ -22,3 +22,35 @@ class MongoDB:
 
     def get_collection(self, collection_name):
         return self._db[collection_name]
+
+
+# Async counterpart used on the request path, so Mongo round trips don't block the event loop
+class AsyncMongoDB:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            mongo_uri = os.getenv("MONGO_URI")
+            cls._client = AsyncMongoClient(mongo_uri)
+            cls._db = cls._client[os.getenv("DB_NAME")]
+        return cls._instance
+
+    @property
+    def db(self):
+        return self._db
+
+    def get_collection(self, collection_name):
+        return self._db[collection_name]
+
+    async def ping(self):
+        await self._db.command("ping")
+
+
+# MongoClient sockets and monitor threads don't survive fork(); forked workers
+# (see serve.py) open their own clients on first use
+def _reset_after_fork():
+    MongoDB._instance = None
+    AsyncMongoDB._instance = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
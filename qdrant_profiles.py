@@ -0,0 +1,139 @@
+import os
+import logging
+from qdrant_client.models import (
+    Disabled,
+    Distance,
+    FieldCondition,
+    Filter,
+    HnswConfigDiff,
+    MatchAny,
+    MatchValue,
+    PayloadSchemaType,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+    VectorParamsDiff,
+)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+VECTOR_SIZE = 384
+
+# Collection profiles, selected with QDRANT_COLLECTION_PROFILE:
+#   default      full-precision vectors in RAM, Qdrant's default HNSW graph
+#   balanced     int8 vectors in RAM for the HNSW walk, originals on disk for rescoring
+#   low_memory   as balanced, with the HNSW graph on disk too
+#   high_recall  denser graph and more rescoring candidates, for larger corpora
+PROFILES = {
+    "default": {
+        "m": 16, "ef_construct": 100, "on_disk": False, "hnsw_on_disk": False,
+        "quantization": False, "rescore": False, "oversampling": None,
+    },
+    "balanced": {
+        "m": 16, "ef_construct": 128, "on_disk": True, "hnsw_on_disk": False,
+        "quantization": True, "rescore": True, "oversampling": 2.0,
+    },
+    "low_memory": {
+        "m": 16, "ef_construct": 128, "on_disk": True, "hnsw_on_disk": True,
+        "quantization": True, "rescore": True, "oversampling": 2.0,
+    },
+    "high_recall": {
+        "m": 32, "ef_construct": 256, "on_disk": True, "hnsw_on_disk": False,
+        "quantization": True, "rescore": True, "oversampling": 3.0,
+    },
+}
+
+# Payload fields used in filters; indexed so filtered searches don't scan payloads
+PAYLOAD_INDEXES = {
+    "source": PayloadSchemaType.KEYWORD,
+    "page": PayloadSchemaType.INTEGER,
+}
+
+
+def get_profile(name=None):
+    name = name or os.getenv("QDRANT_COLLECTION_PROFILE", "default")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown Qdrant collection profile '{name}', expected one of {sorted(PROFILES)}")
+    return PROFILES[name]
+
+
+def _quantization_config(profile):
+    if not profile["quantization"]:
+        return None
+    # Quantized vectors always stay in RAM, whatever the originals' placement
+    return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+
+
+def create_collection(client, collection_name, profile, vector_size=VECTOR_SIZE):
+    """
+    Creates the collection with the profile's vector, HNSW and quantization settings
+    and indexes the filterable payload fields.
+    """
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=profile["on_disk"]),
+        hnsw_config=HnswConfigDiff(m=profile["m"], ef_construct=profile["ef_construct"], on_disk=profile["hnsw_on_disk"]),
+        quantization_config=_quantization_config(profile),
+    )
+    ensure_payload_indexes(client, collection_name)
+
+
+def apply_profile(client, collection_name, profile):
+    """
+    Applies a profile to an existing collection. Qdrant rebuilds the HNSW graph and
+    quantized vectors in the background; searches keep working meanwhile.
+    """
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": VectorParamsDiff(on_disk=profile["on_disk"])},
+        hnsw_config=HnswConfigDiff(m=profile["m"], ef_construct=profile["ef_construct"], on_disk=profile["hnsw_on_disk"]),
+        # None would leave an existing quantization in place
+        quantization_config=_quantization_config(profile) or Disabled.DISABLED,
+    )
+    ensure_payload_indexes(client, collection_name)
+
+
+def ensure_payload_indexes(client, collection_name):
+    # Creating an index that already exists is a no-op in Qdrant
+    for field, schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(collection_name=collection_name, field_name=field, field_schema=schema, wait=True)
+
+
+def search_params(profile, hnsw_ef=None):
+    """
+    Search parameters for a profile: `hnsw_ef` widens the graph search (None keeps
+    Qdrant's default) and quantized profiles rescore oversampled int8 candidates
+    against the original vectors.
+    """
+    quantization = None
+    if profile["quantization"]:
+        quantization = QuantizationSearchParams(rescore=profile["rescore"], oversampling=profile["oversampling"])
+    if hnsw_ef is None and quantization is None:
+        return None
+    return SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
+
+
+def build_filter(filters):
+    """
+    Builds a Qdrant filter from {payload field: value or list of values}; all fields must match.
+    """
+    if not filters:
+        return None
+    conditions = []
+    for key, value in filters.items():
+        match = MatchAny(any=list(value)) if isinstance(value, (list, tuple, set)) else MatchValue(value=value)
+        conditions.append(FieldCondition(key=key, match=match))
+    return Filter(must=conditions)
+
+
+def matches_filter(payload, filters):
+    # The same semantics as build_filter, for payloads searched outside Qdrant
+    for key, value in (filters or {}).items():
+        allowed = value if isinstance(value, (list, tuple, set)) else (value,)
+        if payload.get(key) not in allowed:
+            return False
+    return True
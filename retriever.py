@@ -1,9 +1,16 @@
 import os
 import logging
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
+from typing import Any, List, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from embeddings import get_embedding_model
+from telemetry import record_documents, stage
+from context_packing import VECTOR_METADATA_KEY
+from qdrant_profiles import build_filter, get_profile, matches_filter, search_params
+from vector_snapshot import get_shared_index
 
 # Load environment variables
 load_dotenv()
@@ -11,41 +18,178 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+CONTENT_PAYLOAD_KEY = "page_content"
+
+
+def merge_documents(*result_sets, top_k=5):
+    """
+    Merges several result lists into one, dropping duplicate points and keeping the
+    `top_k` best by score.
+    """
+    merged = {}
+    for docs in result_sets:
+        for doc in docs:
+            key = doc.metadata.get("_id", doc.page_content)
+            if key not in merged or doc.metadata.get("_score", 0) > merged[key].metadata.get("_score", 0):
+                merged[key] = doc
+    ranked = sorted(merged.values(), key=lambda doc: doc.metadata.get("_score", 0), reverse=True)
+    return ranked[:top_k]
+
+
+class QdrantSearchRetriever(BaseRetriever):
+    """
+    LangChain retriever backed by `Retriever.search`/`Retriever.asearch`.
+
+    Unlike the generic vector store wrapper, the async path uses the async Qdrant
+    client instead of running the sync search in a thread pool.
+    """
+
+    store: Any
+    top_k: int = 5
+    score_threshold: float = 0.6
+    filters: Optional[dict] = None
+    with_vectors: bool = False
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.store.search(query, top_k=self.top_k, score_threshold=self.score_threshold, filters=self.filters,
+                                 with_vectors=self.with_vectors)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await self.store.asearch(query, top_k=self.top_k, score_threshold=self.score_threshold, filters=self.filters,
+                                        with_vectors=self.with_vectors)
+
+
 class Retriever:
-    def __init__(self):
+    def __init__(self, qdrant_client=None, async_qdrant_client=None, embedding_model=None):
         # Read collection name from environment variable
         self.collection_name = os.getenv("QDRANT_COLLECTION_NAME")
         if not self.collection_name:
             raise ValueError("QDRANT_COLLECTION_NAME environment variable is not set.")
 
-        # Initialize Qdrant client and embeddings model
-        self.qdrant_client = QdrantClient(
-            url=os.getenv("QDRANT_URL"),
-            api_key=os.getenv("QDRANT_API_KEY")
-        )
-        self.embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        # "qdrant" searches the Qdrant server; "local" searches an in-process snapshot
+        # exported with vector_snapshot.py, with no network dependency
+        self.backend = os.getenv("RETRIEVER_BACKEND", "qdrant")
+        self.local_index = None
+        if self.backend == "local":
+            self.local_index = get_shared_index(
+                os.getenv("VECTOR_SNAPSHOT_DIR", "snapshots"),
+                reload_interval=float(os.getenv("VECTOR_SNAPSHOT_RELOAD_INTERVAL", "5")),
+            )
+        else:
+            # Initialize Qdrant clients (sync and async)
+            self.qdrant_client = qdrant_client or QdrantClient(
+                url=os.getenv("QDRANT_URL"),
+                api_key=os.getenv("QDRANT_API_KEY")
+            )
+            self.async_qdrant_client = async_qdrant_client or AsyncQdrantClient(
+                url=os.getenv("QDRANT_URL"),
+                api_key=os.getenv("QDRANT_API_KEY")
+            )
+
+        # HNSW search width and quantization rescoring for the collection's profile
+        hnsw_ef = os.getenv("QDRANT_HNSW_EF")
+        self.search_params = search_params(get_profile(), int(hnsw_ef) if hnsw_ef else None)
+
+        # Shared, cached query embeddings (see embeddings.py)
+        self.embedding_model = embedding_model or get_embedding_model()
+
+    def _to_document(self, point_id, score, payload, vector=None):
+        payload = dict(payload or {})
+        content = payload.pop(CONTENT_PAYLOAD_KEY, "")
+        metadata = payload.get("metadata") if isinstance(payload.get("metadata"), dict) else payload
+        metadata = dict(metadata)
+        metadata["_id"] = point_id
+        metadata["_score"] = score
+        metadata["_collection_name"] = self.collection_name
+        if vector is not None:
+            # Only for the context packer, which removes it again (see context_packing.py)
+            metadata[VECTOR_METADATA_KEY] = vector
+        return Document(page_content=content, metadata=metadata)
+
+    def _local_search(self, vector, top_k, score_threshold, filters=None, with_vectors=False):
+        payload_filter = (lambda payload: matches_filter(payload, filters)) if filters else None
+        return [
+            self._to_document(*result)
+            for result in self.local_index.search(vector, top_k, score_threshold, payload_filter, with_vectors=with_vectors)
+        ]
+
+    def search(self, query, top_k=5, score_threshold=0.6, filters=None, with_vectors=False):
+        """
+        Embeds the query and runs a similarity search against the collection.
+        
+        Args:
+            query (str): The query text.
+            top_k (int): The number of top documents to retrieve.
+            score_threshold (float): Minimum cosine similarity for a result.
+            filters (dict): Optional payload filter, e.g. {"source": "a.pdf", "page": [1, 2]}.
+            with_vectors (bool): Attach each point's vector for the context packer.
         
-        # Initialize Qdrant retriever with LangChain
-        self.vectorstore = QdrantVectorStore(
-            client=self.qdrant_client,
-            collection_name=self.collection_name,
-            embedding=self.embedding_model
-        )
+        Returns:
+            List[Document]: Matching documents, best first.
+        """
+        with stage("embed"):
+            vector = self.embedding_model.embed_query(query)
+        with stage("search"):
+            if self.local_index is not None:
+                docs = self._local_search(vector, top_k, score_threshold, filters, with_vectors)
+            else:
+                response = self.qdrant_client.query_points(
+                    collection_name=self.collection_name,
+                    query=vector,
+                    limit=top_k,
+                    score_threshold=score_threshold,
+                    query_filter=build_filter(filters),
+                    search_params=self.search_params,
+                    with_payload=True,
+                    with_vectors=with_vectors,
+                )
+                docs = [
+                    self._to_document(point.id, point.score, point.payload, point.vector if with_vectors else None)
+                    for point in response.points
+                ]
+        record_documents(len(docs))
+        return docs
+
+    async def asearch(self, query, top_k=5, score_threshold=0.6, filters=None, with_vectors=False):
+        """
+        Async variant of `search` using the async Qdrant client.
+        """
+        with stage("embed"):
+            vector = await self.embedding_model.aembed_query(query)
+        with stage("search"):
+            if self.local_index is not None:
+                docs = self._local_search(vector, top_k, score_threshold, filters, with_vectors)
+            else:
+                response = await self.async_qdrant_client.query_points(
+                    collection_name=self.collection_name,
+                    query=vector,
+                    limit=top_k,
+                    score_threshold=score_threshold,
+                    query_filter=build_filter(filters),
+                    search_params=self.search_params,
+                    with_payload=True,
+                    with_vectors=with_vectors,
+                )
+                docs = [
+                    self._to_document(point.id, point.score, point.payload, point.vector if with_vectors else None)
+                    for point in response.points
+                ]
+        record_documents(len(docs))
+        return docs
         
-    def get_retriever(self, top_k=5):
+    def get_retriever(self, top_k=5, filters=None, with_vectors=False):
         """
         Returns a retriever object that can be used to retrieve relevant documents.
         
         Args:
             top_k (int): The number of top documents to retrieve.
+            filters (dict): Optional payload filter applied to every search.
+            with_vectors (bool): Attach point vectors to the results' metadata.
         
         Returns:
             A configured retriever object.
         """
-        return self.vectorstore.as_retriever(
-            search_type="similarity_score_threshold",
-            search_kwargs={"k": top_k, "score_threshold": 0.6},
-        )
+        return QdrantSearchRetriever(store=self, top_k=top_k, score_threshold=0.6, filters=filters, with_vectors=with_vectors)
 
     def retrieve(self, query, top_k=5):
         """
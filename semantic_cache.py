@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers to history-free questions by meaning rather than exact text.
+
+    An entry is keyed by the set of retrieved chunk IDs and holds the normalized query
+    embedding. A lookup only considers entries with the same chunks, and returns the
+    stored answer when the cosine similarity of the queries is at least `threshold`.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    beyond `max_entries`.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # entry id -> (chunk key, vector, answer, expires_at)
+        self._by_chunks = {}  # chunk key -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chunk_key(chunk_ids):
+        return tuple(sorted(str(chunk_id) for chunk_id in chunk_ids))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        chunk_key = self._entries.pop(entry_id)[0]
+        ids = self._by_chunks.get(chunk_key)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_chunks[chunk_key]
+
+    def lookup(self, vector, chunk_ids):
+        query = self._normalize(vector)
+        chunk_key = self._chunk_key(chunk_ids)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_chunks.get(chunk_key, ())):
+                _, cached_vector, _, expires_at = self._entries[entry_id]
+                if now >= expires_at:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(query, cached_vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][2]
+
+    def store(self, vector, chunk_ids, answer):
+        chunk_key = self._chunk_key(chunk_ids)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (chunk_key, self._normalize(vector), answer, time.monotonic() + self.ttl)
+            self._by_chunks.setdefault(chunk_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,286 @@
+"""
+Multi-worker server: preload once, then fork.
+
+The parent binds the listening socket and loads everything that is read-only and
+expensive (the app's imports, the embedding model, the local vector snapshot),
+freezes the garbage collector so those objects stay shared copy-on-write, and forks
+the uvicorn workers. Network clients (MongoDB, Qdrant, Auth0 HTTP) are created per
+worker after the fork; modules holding them register `os.register_at_fork` resets.
+
+The parent supervises: a worker that dies is replaced, SIGTERM/SIGINT are forwarded
+for a graceful shutdown, and workers still running after the grace period are killed.
+
+Usage:
+    python serve.py [--workers N] [--host 0.0.0.0] [--port 8000]
+"""
+import os
+import argparse
+import gc
+import glob
+import importlib
+import logging
+import math
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Apps that never embed (or embed with something else) can skip loading the model
+PRELOAD_EMBEDDINGS = os.getenv("PRELOAD_EMBEDDINGS", "true").lower() == "true"
+
+RESTART_BACKOFF = 1.0
+MIN_WORKER_LIFETIME = 5.0
+
+
+def _cgroup_cpu_limit():
+    # CPU quota of the container, or None when unlimited (cgroup v2, then v1)
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """
+    CPUs this process may actually use: its CPU affinity, capped by the cgroup quota.
+    os.cpu_count() reports the host's cores, even in a container limited to a few.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+
+def prepare_metrics_dir():
+    """
+    Must run before prometheus_client is imported: workers then write their samples to
+    files in PROMETHEUS_MULTIPROC_DIR and /metrics aggregates all of them. A configured
+    directory only has its stale *.db files removed; without one, a temporary directory
+    is created and returned so the caller can remove it on exit.
+    """
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+        return None
+    metrics_dir = tempfile.mkdtemp(prefix="prometheus-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    return metrics_dir
+
+
+def bind_socket(host, port, backlog):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def load_app(app_path):
+    module_name, _, attr = app_path.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "app")
+
+
+def preload(app_path, share_state=True):
+    """
+    Loads the app and, with `share_state`, its heavy read-only state in the parent. No
+    model inference runs here, so no native thread pools exist yet when the workers
+    are forked. Without `share_state` (a single worker, nothing to share), the model and
+    snapshot are left to the app's background warm-up, so /healthz answers right away.
+    """
+    started = time.perf_counter()
+    app = load_app(app_path)
+    if not share_state:
+        logging.info(f"Loaded {app_path} in {time.perf_counter() - started:.1f}s")
+        return app
+
+    # LangChain, the Anthropic client and the Qdrant client libraries
+    import conversation  # noqa: F401
+    from embeddings import EMBEDDING_BACKEND, get_base_embedding_model
+    from vector_snapshot import get_shared_index
+
+    if not PRELOAD_EMBEDDINGS:
+        logging.info("Embedding model preload disabled: the model is loaded per worker, if used")
+    elif EMBEDDING_BACKEND == "onnx":
+        # ONNX Runtime sessions start their thread pools on creation, and those threads
+        # don't exist in a forked child; each worker loads its own session
+        logging.info("ONNX embedding backend: the model is loaded per worker")
+    else:
+        get_base_embedding_model()
+
+    if os.getenv("RETRIEVER_BACKEND", "qdrant") == "local":
+        get_shared_index(
+            os.getenv("VECTOR_SNAPSHOT_DIR", "snapshots"),
+            reload_interval=float(os.getenv("VECTOR_SNAPSHOT_RELOAD_INTERVAL", "5")),
+        )
+
+    # Objects that exist now are never collected, so the collector doesn't write to
+    # (and un-share) their pages in every worker
+    gc.collect()
+    gc.freeze()
+    logging.info(f"Preloaded {app_path} in {time.perf_counter() - started:.1f}s ({gc.get_freeze_count()} objects frozen)")
+    return app
+
+
+def run_worker(app, sock, args):
+    # Own process group: a terminal Ctrl-C reaches only the parent, which forwards one
+    # SIGTERM, so workers always get a single signal and shut down gracefully
+    os.setpgid(0, 0)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+
+    # Split the cores between workers instead of every worker using all of them
+    threads = args.threads or max(1, available_cpus() // args.workers)
+    os.environ.setdefault("EMBEDDING_THREADS", str(threads))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+
+    import uvicorn
+
+    config = uvicorn.Config(
+        app,
+        lifespan="on",
+        log_level=args.log_level,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """
+    Forks `workers` copies of the preloaded app onto the shared socket and keeps them running.
+    """
+
+    def __init__(self, app, sock, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.workers = {}  # pid -> start time
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.args)
+            except SystemExit as e:
+                # uvicorn exits this way when the app fails to start
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logging.exception("Worker crashed")
+                code = 1
+            finally:
+                # Never return into the supervisor loop in the child
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        logging.info(f"Started worker {pid}")
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logging.info(f"Received {signal.Signals(signum).name}, stopping {len(self.workers)} workers")
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+        # Workers still running after the grace period are killed
+        signal.alarm(int(self.args.graceful_timeout) + 5)
+
+    def kill_remaining(self, signum, frame):
+        for pid in list(self.workers):
+            logging.warning(f"Worker {pid} did not stop in time, killing it")
+            self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill_remaining)
+
+        for _ in range(self.args.workers):
+            self.spawn()
+
+        from prometheus_client import multiprocess
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            multiprocess.mark_process_dead(pid)
+            if self.stopping:
+                logging.info(f"Worker {pid} exited")
+                continue
+
+            logging.error(f"Worker {pid} exited unexpectedly (exit code {os.waitstatus_to_exitcode(status)}), replacing it")
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                # Crashing right after start; don't fork in a tight loop
+                time.sleep(RESTART_BACKOFF)
+            if not self.stopping:
+                self.spawn()
+        logging.info("All workers stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with preloaded, forked uvicorn workers.")
+    parser.add_argument("--app", default="main:app", help="ASGI app as module:attribute.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or available_cpus(),
+                        help="Worker processes (defaults to the CPUs available to the container).")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WORKER_THREADS", "0")),
+                        help="Compute threads per worker (defaults to cores / workers).")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("GRACEFUL_TIMEOUT", "30")))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    temp_metrics_dir = prepare_metrics_dir()
+    try:
+        sock = bind_socket(args.host, args.port, args.backlog)
+        logging.info(f"Listening on {args.host}:{args.port} with {args.workers} workers")
+        if args.workers > 1:
+            logging.warning("Per-user turn locks, the profile cache and unflushed chat history are per worker; "
+                            "route each user's requests to one worker")
+
+        app = preload(args.app, share_state=args.workers > 1)
+        Supervisor(app, sock, args).run()
+    finally:
+        if temp_metrics_dir:
+            shutil.rmtree(temp_metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
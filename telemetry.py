@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import random
+import inspect
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Histogram, generate_latest, multiprocess
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Fraction of requests logged as one structured line, plus every request slower than the threshold
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv("REQUEST_LOG_SAMPLE_RATE", "0.01"))
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", "5"))
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of request handling.",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds",
+    "End-to-end request latency until the response headers are sent.",
+    ["method", "path", "status"],
+)
+TOKENS = Histogram(
+    "chat_tokens",
+    "Estimated tokens per chat request.",
+    ["kind"],
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+RETRIEVED_DOCUMENTS = Histogram(
+    "chat_retrieved_documents",
+    "Documents retrieved per search.",
+    buckets=(0, 1, 2, 3, 5, 8, 13, 20),
+)
+
+
+class RequestMetrics:
+    """
+    Stage timings and counters collected while handling one request.
+
+    Attributes:
+        timings (dict): Seconds spent per stage; repeated stages accumulate.
+        counts (dict): Per-request counters such as documents and tokens.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.counts = {}
+
+    def add_timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def server_timing(self):
+        # Server-Timing durations are in milliseconds; counts go in the description
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.timings.items()]
+        entries += [f'{name};desc="{value}"' for name, value in self.counts.items()]
+        return ", ".join(entries)
+
+    def as_dict(self):
+        return {
+            "timings_ms": {name: round(seconds * 1000, 1) for name, seconds in self.timings.items()},
+            "counts": dict(self.counts),
+        }
+
+
+# The metrics of the request being handled; code running outside a request records
+# only to the Prometheus histograms
+_current_metrics = contextvars.ContextVar("request_metrics", default=None)
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+def record_stage(name, seconds):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_timing(name, seconds)
+
+
+def record_documents(count):
+    RETRIEVED_DOCUMENTS.observe(count)
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_count("docs", count)
+
+
+def record_tokens(kind, count):
+    TOKENS.labels(kind).observe(count)
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_count(f"{kind}_tokens", count)
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorator timing every call of a sync or async function as stage `name`."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metrics_response_body():
+    # With several workers (serve.py sets PROMETHEUS_MULTIPROC_DIR) every worker writes
+    # its samples to files there, and any worker can report the aggregate
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware giving each HTTP request its own `RequestMetrics`.
+
+    Stages finished before the response starts are reported in a `Server-Timing`
+    header, so for streamed responses it covers the work up to the first byte.
+    One structured log line is written for a sample of requests and for every
+    slow one, instead of logging payloads on each request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # Unmatched paths share one label so scanners can't grow the series count
+                path = scope["path"] if message["status"] != 404 else "unmatched"
+                REQUEST_SECONDS.labels(scope["method"], path, str(message["status"])).observe(
+                    time.perf_counter() - metrics.started
+                )
+                header = metrics.server_timing()
+                if header:
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_metrics.reset(token)
+            elapsed = time.perf_counter() - metrics.started
+            if elapsed >= SLOW_REQUEST_THRESHOLD or random.random() < REQUEST_LOG_SAMPLE_RATE:
+                logging.info(json.dumps({
+                    "event": "request",
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "duration_ms": round(elapsed * 1000, 1),
+                    **metrics.as_dict(),
+                }))
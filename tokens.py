@@ -0,0 +1,17 @@
+# Cheap token estimates for prompt budgeting.
+#
+# Claude's tokenizer isn't available offline, so budgets use the usual ~4 characters
+# per token approximation. It only has to be consistent, not exact.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_message_tokens(message) -> int:
+    # A few tokens of overhead for the role/formatting around each message
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return estimate_tokens(content) + 4
@@ -1,10 +1,18 @@
 import os
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from fastapi import HTTPException
-from auth import get_auth0_token
-import requests
-from chat_message import deserialize_message, serialize_message
-from mongodb import MongoDB
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+from auth import AUTH0_TIMEOUT, auth0_session, get_auth0_token, invalidate_auth0_token
+from chat_message import LazyHistory, deserialize_message, serialize_message
+from history_writer import HistoryWriter
+from mongodb import AsyncMongoDB, MongoDB
+from telemetry import timed
 
 load_dotenv()
 
@@ -13,43 +21,176 @@ AUTH0_CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
 AUTH0_CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
 AUTH0_AUDIENCE = os.getenv("AUTH0_AUDIENCE")
 
+# Number of most recent turns (human + assistant message) loaded for each chat request
+CHAT_HISTORY_WINDOW_TURNS = int(os.getenv("CHAT_HISTORY_WINDOW_TURNS", "10"))
 
-# MongoDB Singleton Instance
-mongo_instance = MongoDB()
+
+# Profile cache settings; USER_PROFILE_WATCH keeps the caches of several workers in sync
+# through a change stream on 'users' (replica sets only, otherwise entries just expire)
+USER_PROFILE_CACHE_TTL = float(os.getenv("USER_PROFILE_CACHE_TTL", "60"))
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", "10000"))
+USER_PROFILE_WATCH = os.getenv("USER_PROFILE_WATCH", "true").lower() == "true"
+USER_PROFILE_WATCH_RETRY = float(os.getenv("USER_PROFILE_WATCH_RETRY", "30"))
+
+# Write-behind chat history: turns are saved in the background after the response
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "true").lower() == "true"
+# History reads retried when a flush lands mid-read, before falling back to the seq filter
+HISTORY_READ_ATTEMPTS = 3
+
+# Server error codes: duplicate key, index options/spec conflicts, change streams unsupported
+DUPLICATE_KEY_ERRORS = {11000, 85, 86}
+CHANGE_STREAM_UNSUPPORTED = {40573}
+
+# MongoDB singletons are created on first use rather than at import (the async one
+# serves the request path)
+
+
+class ProfileCache:
+    """
+    Bounded, TTL-based cache of user documents keyed by Auth0 ID.
+
+    Missing users are cached too, so polling for an unknown user doesn't hit Mongo.
+    A fill started before a concurrent write or invalidation of the same user is
+    dropped, so a slow read can't put back a profile that was changed meanwhile.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        # Write clock: per-user clock of the last write, oldest first, and the newest
+        # clock no longer tracked there (evicted, or a full invalidation)
+        self._clock = 0
+        self._writes = OrderedDict()
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def get(self, auth0_id: str):
+        """Returns (found, user document or None)."""
+        with self._lock:
+            entry = self._entries.get(auth0_id)
+            if entry is None or time.monotonic() >= entry[1]:
+                if entry is not None:
+                    del self._entries[auth0_id]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(auth0_id)
+            self.hits += 1
+            return True, entry[0]
+
+    def generation(self):
+        with self._lock:
+            return self._clock
+
+    def fill(self, auth0_id: str, user_data, generation: int):
+        # Read-through fill; skipped if this user was written since `generation`
+        with self._lock:
+            if self._writes.get(auth0_id, 0) <= generation and self._forgotten <= generation:
+                self._store(auth0_id, user_data)
+
+    def put(self, auth0_id: str, user_data):
+        # Write-through from our own writes and from change events
+        with self._lock:
+            self._record_write(auth0_id)
+            self._store(auth0_id, user_data)
+
+    def update_if_cached(self, auth0_id: str, user_data):
+        with self._lock:
+            self._record_write(auth0_id)
+            if auth0_id in self._entries:
+                self._store(auth0_id, user_data)
+
+    def invalidate(self, auth0_id: str = None):
+        # Drops one user, or everything when no ID is given
+        with self._lock:
+            if auth0_id is None:
+                self._clock += 1
+                self._writes.clear()
+                self._forgotten = self._clock
+                self._entries.clear()
+            else:
+                self._record_write(auth0_id)
+                self._entries.pop(auth0_id, None)
+
+    def _record_write(self, auth0_id):
+        self._clock += 1
+        self._writes[auth0_id] = self._clock
+        self._writes.move_to_end(auth0_id)
+        # Only fills that started before the evicted write are affected by forgetting it
+        while len(self._writes) > self.max_entries:
+            _, self._forgotten = self._writes.popitem(last=False)
+
+    def _store(self, auth0_id, user_data):
+        self._entries[auth0_id] = (user_data, time.monotonic() + self.ttl)
+        self._entries.move_to_end(auth0_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+profile_cache = ProfileCache(max_entries=USER_PROFILE_CACHE_SIZE, ttl=USER_PROFILE_CACHE_TTL)
+
+history_writer = HistoryWriter(
+    lambda name: AsyncMongoDB().get_collection(name),
+    flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.2")),
+    max_batch_messages=int(os.getenv("HISTORY_FLUSH_BATCH_MESSAGES", "500")),
+    max_retries=int(os.getenv("HISTORY_FLUSH_RETRIES", "5")),
+)
 
 # Function to sign up a user and store their information in MongoDB
 def sign_up_user(email: str, password: str):
-    headers = {
-        "Authorization": f"Bearer {get_auth0_token()}",
-        "content-type": "application/json"
-    }
-
     user_data = {
         "email": email,
         "password": password,
         "connection": "Username-Password-Authentication"
     }
 
-    # Create user in Auth0
-    response = requests.post(f'https://{AUTH0_DOMAIN}/api/v2/users', json=user_data, headers=headers)
+    # Create user in Auth0, re-issuing the management token once if it was revoked
+    response = _create_auth0_user(user_data)
+    if response.status_code == 401:
+        invalidate_auth0_token()
+        response = _create_auth0_user(user_data)
     if response.status_code == 201:
         user_info = response.json()
         
 
         # Store user in MongoDB
-        users_collection = mongo_instance.get_collection("users")
+        users_collection = MongoDB().get_collection("users")
         new_user = {
             "auth0_id": user_info["user_id"],
             "email": email,
             "metadata": user_info.get("user_metadata", {})
         }
         users_collection.insert_one(new_user)  # Insert user data into MongoDB
+        profile_cache.invalidate(new_user["auth0_id"])
 
         return {"message": "User created and stored successfully"}
     else:
         raise HTTPException(status_code=400, detail="Sign-up failed")
 
 
+def _create_auth0_user(user_data: dict):
+    headers = {
+        "Authorization": f"Bearer {get_auth0_token()}",
+        "content-type": "application/json"
+    }
+    return auth0_session.post(f'https://{AUTH0_DOMAIN}/api/v2/users', json=user_data, headers=headers, timeout=AUTH0_TIMEOUT)
+
+
 # Function to log in a user
 def login_user(email: str, password: str):
     login_data = {
@@ -64,7 +205,7 @@ def login_user(email: str, password: str):
     }
 
     # Requesting the token from Auth0
-    response = requests.post(f'https://{AUTH0_DOMAIN}/oauth/token', json=login_data)
+    response = auth0_session.post(f'https://{AUTH0_DOMAIN}/oauth/token', json=login_data, timeout=AUTH0_TIMEOUT)
     if response.status_code == 200:
         return response.json()  # Return JWT token
     else:
@@ -72,40 +213,188 @@ def login_user(email: str, password: str):
 
 
 # Function to select a character and store it in MongoDB
-def choose_character(auth0_id: str, selected_character: str):
+async def choose_character(auth0_id: str, selected_character: str):
     if selected_character not in ["girl", "boy"]:
         raise HTTPException(status_code=400, detail="Invalid character selection")
 
     # Get the users collection and update the user's selected character
-    users_collection = mongo_instance.get_collection("users")
-    users_collection.update_one(
+    users_collection = AsyncMongoDB().get_collection("users")
+    user_data = await users_collection.find_one_and_update(
         {"auth0_id": auth0_id},  # 'auth0_id' contains the user's unique identifier
         {"$set": {"selected_character": selected_character}},
-        upsert=True
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
     )
+    profile_cache.put(auth0_id, user_data)
 
     return {"message": "Character selected successfully"}
 
-def get_user(auth0_id: str):
-    users_collection = mongo_instance.get_collection("users")
-    user_data = users_collection.find_one({"auth0_id": auth0_id})
-    return user_data
+# Function to get a user's profile, served from the profile cache when possible
+async def get_user(auth0_id: str):
+    found, user_data = profile_cache.get(auth0_id)
+    if not found:
+        generation = profile_cache.generation()
+        users_collection = AsyncMongoDB().get_collection("users")
+        user_data = await users_collection.find_one({"auth0_id": auth0_id})
+        profile_cache.fill(auth0_id, user_data, generation)
+    # Callers get their own copy, so they can't modify the cached document
+    return dict(user_data) if user_data is not None else None
+
+# Function to keep the profile cache in sync with writes made by other workers
+async def watch_user_profiles():
+    """
+    Applies changes to 'users' from a change stream to the profile cache. Runs until
+    cancelled; without change stream support (standalone server) it returns and
+    cached profiles are only refreshed by their TTL.
+    """
+    users_collection = AsyncMongoDB().get_collection("users")
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    while True:
+        try:
+            async with await users_collection.watch(pipeline, full_document="updateLookup") as stream:
+                # Events may have been missed while the stream was down
+                profile_cache.invalidate()
+                logging.info("Watching user profile changes")
+                async for change in stream:
+                    user_data = change.get("fullDocument")
+                    if user_data is None or "auth0_id" not in user_data:
+                        # Deletes only carry the _id, which the cache isn't keyed by
+                        profile_cache.invalidate()
+                    else:
+                        profile_cache.update_if_cached(user_data["auth0_id"], user_data)
+        except OperationFailure as e:
+            if e.code in CHANGE_STREAM_UNSUPPORTED:
+                logging.info(f"Change streams unavailable, profile cache entries expire after {USER_PROFILE_CACHE_TTL}s")
+                return
+            logging.warning(f"User profile change stream failed, retrying in {USER_PROFILE_WATCH_RETRY}s: {e}")
+        except PyMongoError as e:
+            logging.warning(f"User profile change stream failed, retrying in {USER_PROFILE_WATCH_RETRY}s: {e}")
+        await asyncio.sleep(USER_PROFILE_WATCH_RETRY)
     
-def get_chat_history(auth0_id: str):
-    chat_history_collection = mongo_instance.get_collection("chat-history")
-    chat_history_records = chat_history_collection.find_one({"user_id": auth0_id})
-    serialized_history = chat_history_records.get("chat_history", []) if chat_history_records else []
-    chat_history = [deserialize_message(msg) for msg in serialized_history]
-    return chat_history
+# Chat history is stored one document per message in 'chat-messages', keyed by (user_id, seq).
+# The per-user 'chat-history' document only holds the last allocated 'seq'.
+async def ensure_indexes():
+    await AsyncMongoDB().get_collection("chat-messages").create_index(
+        [("user_id", ASCENDING), ("seq", ASCENDING)], unique=True
+    )
+    await AsyncMongoDB().get_collection("chat-history").create_index("user_id", unique=True)
 
-# Function to select a character and store it in MongoDB
-def save_chat_history(auth0_id: str, chat_history: any):
-    chat_history_collection = mongo_instance.get_collection("chat-history")
-    serialized_history = [serialize_message(msg) for msg in chat_history]
-    chat_history_collection.update_one(
+    # Profile lookups by Auth0 ID; falls back to a plain index while duplicate users exist
+    users_collection = AsyncMongoDB().get_collection("users")
+    try:
+        await users_collection.create_index("auth0_id", unique=True)
+    except OperationFailure as e:
+        if e.code not in DUPLICATE_KEY_ERRORS:
+            raise
+        logging.error(f"Could not create a unique index on users.auth0_id (duplicate users or an existing non-unique index): {e}")
+        indexes = await users_collection.index_information()
+        if not any(index["key"][0][0] == "auth0_id" for index in indexes.values()):
+            await users_collection.create_index("auth0_id", name="auth0_id_lookup")
+
+def _after_seq_filter(auth0_id: str, after_seq):
+    query = {"user_id": auth0_id}
+    if after_seq is not None:
+        query["seq"] = {"$gt": after_seq}
+    return query
+
+async def get_chat_records(auth0_id: str, after_seq=None, limit: int = CHAT_HISTORY_WINDOW_TURNS * 2, oldest: bool = False):
+    """
+    Returns `limit` messages after `after_seq` as (seq, message) pairs, oldest first:
+    the newest ones, or with `oldest` the ones directly following `after_seq`.
+    """
+    chat_messages_collection = AsyncMongoDB().get_collection("chat-messages")
+    cursor = chat_messages_collection.find(
+        _after_seq_filter(auth0_id, after_seq),
+        {"_id": 0, "user_id": 0},
+    ).sort("seq", ASCENDING if oldest else DESCENDING).limit(limit)
+    records = await cursor.to_list(length=limit)
+    if not oldest:
+        records.reverse()
+    return [(record.pop("seq"), deserialize_message(record)) for record in records]
+
+@timed("history_load")
+async def get_chat_history(auth0_id: str, turns: int = CHAT_HISTORY_WINDOW_TURNS, after_seq=None):
+    limit = turns * 2
+
+    serialized_history = []
+    for _ in range(HISTORY_READ_ATTEMPTS):
+        flushes = history_writer.flushes
+        # Messages still waiting in the write-behind queue are newer than anything stored
+        if history_writer.pending_count(auth0_id) >= limit:
+            serialized_history = []
+            break
+        chat_messages_collection = AsyncMongoDB().get_collection("chat-messages")
+        cursor = chat_messages_collection.find(
+            _after_seq_filter(auth0_id, after_seq),
+            {"_id": 0, "user_id": 0},
+        ).sort("seq", DESCENDING).limit(limit)
+        serialized_history = await cursor.to_list(length=limit)
+        serialized_history.reverse()
+        # A flush that completed during the read may have stored messages after the
+        # query ran and already dropped them from the queue; read again
+        if history_writer.flushes == flushes:
+            break
+
+    # Taken after the read: messages stored meanwhile carry their seq and are dropped here
+    pending = history_writer.pending_messages(auth0_id)[-limit:]
+    last_seq = serialized_history[-1]["seq"] if serialized_history else None
+    serialized_history += [doc for seq, doc in pending if seq is None or last_seq is None or seq > last_seq]
+
+    # Messages are only built when the prompt actually uses them
+    return LazyHistory(serialized_history[-limit:])
+
+# Function to get the per-user history bookkeeping: last seq and the rolling summary
+@timed("history_state")
+async def get_history_state(auth0_id: str):
+    chat_history_collection = AsyncMongoDB().get_collection("chat-history")
+    record = await chat_history_collection.find_one(
+        {"user_id": auth0_id},
+        {"_id": 0, "seq": 1, "summary": 1, "summary_upto": 1},
+    ) or {}
+    return {
+        "seq": record.get("seq", 0),
+        "summary": record.get("summary", ""),
+        "summary_upto": record.get("summary_upto"),
+        "pending": history_writer.pending_count(auth0_id),
+    }
+
+# Function to store a new rolling summary, unless another worker already moved it
+async def save_history_summary(auth0_id: str, summary: str, upto_seq: int, expected_upto=None):
+    chat_history_collection = AsyncMongoDB().get_collection("chat-history")
+    result = await chat_history_collection.update_one(
+        {"user_id": auth0_id, "summary_upto": expected_upto},
+        {"$set": {"summary": summary, "summary_upto": upto_seq}},
+    )
+    return result.modified_count == 1
+
+# Function to append new messages to a user's chat history
+@timed("history_save")
+async def append_chat_history(auth0_id: str, messages: list):
+    if not messages:
+        return {"message": "Chat history saved successfully"}
+
+    # Reserve a contiguous range of sequence numbers for the new messages
+    chat_history_collection = AsyncMongoDB().get_collection("chat-history")
+    counter = await chat_history_collection.find_one_and_update(
         {"user_id": auth0_id},  # 'auth0_id' contains the user's unique identifier
-        {"$set": {"chat_history": serialized_history}},
-        upsert=True
+        {"$inc": {"seq": len(messages)}},
+        projection={"seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
     )
+    first_seq = counter["seq"] - len(messages) + 1
+
+    chat_messages_collection = AsyncMongoDB().get_collection("chat-messages")
+    await chat_messages_collection.insert_many([
+        {"user_id": auth0_id, "seq": first_seq + i, **serialize_message(msg)}
+        for i, msg in enumerate(messages)
+    ])
 
     return {"message": "Chat history saved successfully"}
+
+# Function to save a completed turn: queued for the write-behind writer, or written now
+async def save_chat_turn(auth0_id: str, messages: list):
+    if HISTORY_WRITE_BEHIND:
+        history_writer.enqueue(auth0_id, messages)
+    else:
+        await append_chat_history(auth0_id, messages)
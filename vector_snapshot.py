@@ -0,0 +1,241 @@
+import os
+import argparse
+import json
+import logging
+import shutil
+import threading
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# A snapshot directory holds one sub-directory per exported version and a CURRENT
+# file naming the live one; CURRENT is replaced atomically once a version is complete.
+CURRENT_FILENAME = "CURRENT"
+
+
+def export_snapshot(qdrant_client, collection_name, snapshot_dir, quantize=False, batch_size=1024, keep_versions=2):
+    """
+    Exports a Qdrant collection's vectors and payloads to a local snapshot.
+
+    Vectors are L2-normalized so cosine similarity becomes a dot product. With
+    `quantize`, they are stored as int8 with one float32 scale per row.
+    
+    Args:
+        qdrant_client (QdrantClient): Client to read the collection from.
+        collection_name (str): Collection to export.
+        snapshot_dir (str): Directory holding snapshot versions.
+        quantize (bool): Store int8-quantized vectors instead of float32.
+        batch_size (int): Points fetched per scroll request.
+        keep_versions (int): Versions kept on disk, including the new one.
+    
+    Returns:
+        str: Path of the exported version.
+
+    Raises:
+        ValueError: If the collection has no points.
+    """
+    ids, payloads, vectors = [], [], []
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        for point in points:
+            ids.append(point.id)
+            payloads.append(point.payload or {})
+            vectors.append(point.vector)
+        if offset is None:
+            break
+
+    if not vectors:
+        # Publishing it would also replace the live snapshot with an empty one
+        raise ValueError(f"Collection '{collection_name}' has no points; nothing to export")
+
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}"
+    version_dir = os.path.join(snapshot_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    if quantize:
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        np.save(os.path.join(version_dir, "vectors.npy"), np.round(matrix / scales[:, None]).astype(np.int8))
+        np.save(os.path.join(version_dir, "scales.npy"), scales.astype(np.float32))
+    else:
+        np.save(os.path.join(version_dir, "vectors.npy"), matrix)
+
+    with open(os.path.join(version_dir, "payloads.json"), "w") as f:
+        json.dump({"ids": ids, "payloads": payloads}, f)
+    with open(os.path.join(version_dir, "meta.json"), "w") as f:
+        json.dump({"collection": collection_name, "count": len(ids), "dim": matrix.shape[1], "quantized": quantize}, f)
+
+    # Publish the new version
+    current_path = os.path.join(snapshot_dir, CURRENT_FILENAME)
+    with open(f"{current_path}.tmp", "w") as f:
+        f.write(version)
+    os.replace(f"{current_path}.tmp", current_path)
+
+    # Drop old versions; processes still mapping them keep their open files
+    versions = sorted(
+        name for name in os.listdir(snapshot_dir)
+        if os.path.isdir(os.path.join(snapshot_dir, name))
+    )
+    for name in versions[:-keep_versions]:
+        shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+    logging.info(f"Exported {len(ids)} points from {collection_name} to {version_dir}")
+    return version_dir
+
+
+class LocalVectorIndex:
+    """
+    In-process, read-only vector index over a snapshot written by `export_snapshot`.
+
+    The vector matrix is memory-mapped and searched with a vectorized dot product.
+    The CURRENT file is re-checked at most every `reload_interval` seconds and a new
+    version is swapped in without blocking searches.
+    """
+
+    def __init__(self, snapshot_dir, reload_interval=5.0):
+        self.snapshot_dir = snapshot_dir
+        self.reload_interval = reload_interval
+        self._state = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.reload()
+        if self._state is None:
+            raise ValueError(f"No vector snapshot found in {snapshot_dir}")
+
+    @property
+    def version(self):
+        return self._state["version"] if self._state else None
+
+    def _current_version(self):
+        try:
+            with open(os.path.join(self.snapshot_dir, CURRENT_FILENAME)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        self._last_check = time.monotonic()
+        version = self._current_version()
+        if version is None or version == self.version:
+            return False
+
+        version_dir = os.path.join(self.snapshot_dir, version)
+        vectors = np.load(os.path.join(version_dir, "vectors.npy"), mmap_mode="r")
+        scales_path = os.path.join(version_dir, "scales.npy")
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        with open(os.path.join(version_dir, "payloads.json")) as f:
+            table = json.load(f)
+
+        # Swap the whole state at once so concurrent searches see either version
+        self._state = {
+            "version": version,
+            "vectors": vectors,
+            "scales": scales,
+            "ids": table["ids"],
+            "payloads": table["payloads"],
+        }
+        logging.info(f"Loaded vector snapshot {version} ({len(table['ids'])} points)")
+        return True
+
+    def _maybe_reload(self):
+        if time.monotonic() - self._last_check < self.reload_interval:
+            return
+        if self._reload_lock.acquire(blocking=False):
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error(f"Failed to reload vector snapshot: {e}")
+            finally:
+                self._reload_lock.release()
+
+    def search(self, vector, top_k=5, score_threshold=None, payload_filter=None, with_vectors=False):
+        """
+        Cosine top-k search, optionally restricted to points whose payload passes
+        `payload_filter`.
+        
+        Returns:
+            list: (id, score, payload) tuples, best first, with score >= score_threshold;
+            with `with_vectors`, (id, score, payload, vector) with the normalized float32
+            vector (dequantized for int8 snapshots).
+        """
+        self._maybe_reload()
+        state = self._state
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        scores = state["vectors"] @ query
+        if state["scales"] is not None:
+            scores = scores * state["scales"]
+        if payload_filter is not None:
+            keep = np.fromiter((payload_filter(payload) for payload in state["payloads"]), dtype=bool, count=len(scores))
+            scores = np.where(keep, scores, -np.inf)
+            top_k = min(top_k, int(keep.sum()))
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        if score_threshold is not None:
+            top = [i for i in top if scores[i] >= score_threshold]
+        if not with_vectors:
+            return [(state["ids"][i], float(scores[i]), state["payloads"][i]) for i in top]
+        return [
+            (state["ids"][i], float(scores[i]), state["payloads"][i], self._vector(state, i))
+            for i in top
+        ]
+
+    @staticmethod
+    def _vector(state, i):
+        vector = np.asarray(state["vectors"][i], dtype=np.float32)
+        if state["scales"] is not None:
+            vector = vector * state["scales"][i]
+        return vector.tolist()
+
+
+# One index per snapshot directory and process; loaded before forking workers
+# (see serve.py), its arrays and payloads are shared copy-on-write
+_shared_indexes = {}
+_shared_indexes_lock = threading.Lock()
+
+def get_shared_index(snapshot_dir, reload_interval=5.0):
+    with _shared_indexes_lock:
+        if snapshot_dir not in _shared_indexes:
+            _shared_indexes[snapshot_dir] = LocalVectorIndex(snapshot_dir, reload_interval=reload_interval)
+        return _shared_indexes[snapshot_dir]
+
+
+def main():
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Export the Qdrant collection to a local vector snapshot.")
+    parser.add_argument("--dir", default=os.getenv("VECTOR_SNAPSHOT_DIR", "snapshots"), help="Snapshot directory.")
+    parser.add_argument("--int8", action="store_true", help="Store int8-quantized vectors.")
+    args = parser.parse_args()
+
+    client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+    export_snapshot(client, os.getenv("QDRANT_COLLECTION_NAME"), args.dir, quantize=args.int8)
+
+
+# Usage: python vector_snapshot.py [--dir snapshots] [--int8]
+if __name__ == "__main__":
+    main()